@@ -1,43 +1,388 @@
 import pygame as pyg
+import argparse
+import json
+import mmap
 import os
+import struct
+import time
 
-from main import get_path
 
-player_assets = {'img_sheet': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'player', 'normal_sheet.png'))).convert_alpha(),
-                 'score_sound': pyg.mixer.Sound(get_path(os.path.join('assets', 'audio', 'score_up.wav')))}
+# What main.py gets from 'from asset_loader import *'. The loader helpers
+# and the modules imported here stay out of its namespace.
+__all__ = ['load_times', 'fonts', 'get_font',
+           'player_assets', 'sounds', 'pickup_assets', 'slingshot_assets',
+           'lasergun_assets', 'archer_assets', 'charger_assets', 'dummy_assets',
+           'hud_assets', 'world_decor_assets', 'static_assets', 'wall_assets',
+           'mouse_assets', 'asset_groups', 'first_frame_assets', 'level_assets']
 
-pickup_assets = {'shadow': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'shadows', 'pickup.png'))).convert_alpha(),
-                 'cube': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'pickups', 'cube.png'))),
-                 'hp': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'pickups', 'hp.png')))}
 
-fonts = {'apache32': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'apache.ttf')), 32),
-         'apache30': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'apache.ttf')), 30),
-         'coffee30': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'coffee.ttf')), 30),
-         'coffee24': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'coffee.ttf')), 24),
-         'londrina36': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'Londrina.otf')), 36),
-         'londrina40': pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'Londrina.otf')), 40)}
+def get_path(path):
+    """Returns the full file path of a file."""
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(dirname, path)
 
-slingshot_assets = {'slingshot': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'weapons', 'slingshot.png'))).convert_alpha(),
-                    'pebble': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'weapons', 'pebble.png'))).convert_alpha()}
 
-lasergun_assets = {'lasergun': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'weapons', 'lasergun.png'))).convert_alpha()}
+# Seconds spent loading each group, for the startup report
+load_times = {}
 
-archer_assets = {'archer': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'archer.png'))).convert_alpha(),
-                 'arrow': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'arrow.png'))).convert_alpha()}
 
-charger_assets = {'charger': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'charger.png'))).convert_alpha()}
+class AssetGroup():
+    def __init__(self, name, loaders):
+        """A dict of assets that loads each one the first time it is asked
+        for, instead of all of them when the game starts. loaders maps each
+        key to a function that loads that asset.
 
-dummy_assets = {'dummy': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'Dummy.png'))).convert_alpha()}
+        A loader can also have a decode() attribute, which does the slow
+        part of loading without touching the display, so it is safe to call
+        from another thread. The loader then finishes the job quickly."""
+        self.name = name
+        self.loaders = loaders
+        self.assets = {}
 
-hud_assets = {'hp': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'hud', 'hp.png'))).convert_alpha()}
+    def __getitem__(self, key):
+        if key not in self.assets:
+            start = time.perf_counter()
+            self.assets[key] = self.loaders[key]()
+            load_times[self.name] = load_times.get(self.name, 0) + time.perf_counter() - start
+        return self.assets[key]
 
-world_decor_assets = {'bg_set_1': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'background', 'bg_set_1.png'))),
-                      'bg_set_2': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'background', 'bg_set_2.png'))),
-                      'bg_set_3': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'background', 'bg_set_3.png'))),
-                      'bg_set_4': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'background', 'bg_set_4.png')))}
+    def __contains__(self, key):
+        return key in self.loaders
 
-static_assets = {'fountain': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'fountain.png'))),
-                 'ladder_up': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'ladder', 'up.png'))),
-                 'ladder_down': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'ladder', 'down.png')))}
+    def keys(self):
+        return self.loaders.keys()
 
-mouse_assets = {'pointer': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'misc', 'mouse', 'target.png'))).convert_alpha()}
+    def preload(self):
+        for key in self.loaders:
+            self[key]
+
+    def decode(self):
+        """Decode every asset that hasn't been loaded yet. Safe to call from
+        a worker thread, the assets are finished by preload() or when they
+        are first used."""
+        loaders = [loader for key, loader in list(self.loaders.items())
+                   if key not in self.assets and hasattr(loader, 'decode')]
+        if not loaders:
+            return
+
+        start = time.perf_counter()
+        for loader in loaders:
+            loader.decode()
+        load_times[f'{self.name} (decode)'] = time.perf_counter() - start
+
+
+class AssetBundle():
+    # File layout: magic, version, length of the JSON index, the index, then
+    # the raw RGBA pixels of every image, each starting on a 16 byte boundary
+    magic = b'NRAB'
+    version = 1
+    header = struct.Struct('<4sHI')
+
+    def __init__(self, path):
+        """Every image under assets/imgs, already decoded, in one file. The
+        file is memory mapped and surfaces are made straight from it, so
+        there is no PNG decoding at runtime. Each image remembers the size
+        and modification time of the PNG it came from. If the PNG has
+        changed, or there is no bundle, get() returns None and the image
+        should be loaded from its PNG instead."""
+        self.path = path
+        self.is_open = False
+        self.index = {}
+
+    def open(self):
+        """Map the file and read its index. A bundle that is missing,
+        truncated or damaged is left with an empty index, so every image
+        falls back to its PNG."""
+        self.is_open = True
+        try:
+            with open(self.path, 'rb') as f:
+                # Copy on write, so drawing on a surface can't change the file
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+            magic, version, index_len = self.header.unpack_from(self.data)
+            if magic != self.magic or version != self.version:
+                return
+            start = self.header.size
+            if start + index_len > len(self.data):
+                return
+            index = json.loads(bytes(self.data[start:start + index_len]))
+            if not isinstance(index, dict):
+                return
+        except (OSError, ValueError, struct.error, json.JSONDecodeError):
+            return
+
+        # Drop any entry that doesn't make sense or runs past the end of the
+        # file, rather than reading garbage for it
+        self.index = {rel_path: entry for rel_path, entry in index.items() if self.entry_fits(entry)}
+
+    def entry_fits(self, entry):
+        if (not isinstance(entry, list) or len(entry) != 5 or
+            not all(isinstance(value, int) for value in entry)):
+            return False
+        offset, width, height, mtime, size = entry
+        return (offset >= self.header.size and width > 0 and height > 0 and
+                offset + width * height * 4 <= len(self.data))
+
+    def get(self, rel_path):
+        """Return a surface for the image at rel_path, or None if the bundle
+        doesn't have an up to date copy of it."""
+        if not self.is_open:
+            self.open()
+
+        entry = self.index.get(rel_path)
+        if entry is None:
+            return None
+
+        offset, width, height, mtime, size = entry
+        try:
+            stat = os.stat(get_path(rel_path))
+        except OSError:
+            return None
+        if stat.st_mtime_ns != mtime or stat.st_size != size:
+            return None
+
+        pixels = memoryview(self.data)[offset:offset + width * height * 4]
+        try:
+            return pyg.image.frombuffer(pixels, (width, height), 'RGBA')
+        except ValueError:
+            return None
+
+    @classmethod
+    def build(cls, path):
+        """Decode every PNG under assets/imgs and write them to a bundle at
+        path. Returns the number of images written."""
+        root = get_path('')
+        images = []
+        for dirpath, dirnames, filenames in os.walk(get_path(os.path.join('assets', 'imgs'))):
+            # Source files for editing are never loaded by the game
+            dirnames[:] = sorted(d for d in dirnames if d != 'source')
+            for filename in sorted(filenames):
+                if filename.endswith('.png'):
+                    images.append(os.path.relpath(os.path.join(dirpath, filename), root))
+
+        index = {}
+        pixel_data = []
+        offset = 0
+        for rel_path in images:
+            surface = pyg.image.load(get_path(rel_path))
+            pixels = pyg.image.tobytes(surface, 'RGBA')
+            stat = os.stat(get_path(rel_path))
+            index[rel_path.replace(os.sep, '/')] = [offset, surface.get_width(), surface.get_height(),
+                                                    stat.st_mtime_ns, stat.st_size]
+
+            pixels += bytes(-len(pixels) % 16)
+            pixel_data.append(pixels)
+            offset += len(pixels)
+
+        # Offsets in the index are from the start of the file, which depends
+        # on the length of the index, so make its length a multiple of 16 and
+        # shift the offsets by it until they agree
+        start = 0
+        while True:
+            index_bytes = json.dumps({k: [v[0] + start] + v[1:] for k, v in index.items()}).encode()
+            index_bytes += b' ' * (-(cls.header.size + len(index_bytes)) % 16)
+            if cls.header.size + len(index_bytes) == start:
+                break
+            start = cls.header.size + len(index_bytes)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, cls.version, len(index_bytes)))
+            f.write(index_bytes)
+            for pixels in pixel_data:
+                f.write(pixels)
+        os.replace(tmp_path, path)
+
+        return len(images)
+
+
+bundle = AssetBundle(get_path(os.path.join('assets', 'bundle.nrab')))
+
+
+def image(*path, alpha=True):
+    """A loader for an image under assets/imgs. The image is converted for
+    fast blitting with alpha, or left as it was loaded if alpha is False.
+    Images come from the asset bundle when it is up to date."""
+    decoded = []
+
+    def decode():
+        if not decoded:
+            rel_path = '/'.join(('assets', 'imgs') + path)
+            surface = bundle.get(rel_path)
+            if surface is None:
+                surface = pyg.image.load(get_path(os.path.join('assets', 'imgs', *path)))
+            decoded.append(surface)
+        return decoded[0]
+
+    def load():
+        surface = decode()
+        decoded.clear()
+        return surface.convert_alpha() if alpha else surface
+    load.decode = decode
+    return load
+
+
+class Atlas():
+    def __init__(self, name, width=1024):
+        """Packs many small images into one large surface. Images are added
+        with add(), and the first time any of them is used they are all
+        loaded and packed into rows, tallest first. Each image is then a
+        subsurface of the atlas, so drawing it is an area blit from the one
+        big surface."""
+        self.name = name
+        self.width = width
+        self.loaders = {}
+
+        self.surface = None
+        self.manifest = {}
+
+    def add(self, key, loader):
+        """Add an image to the atlas, returning a loader for it."""
+        self.loaders[key] = loader
+        def load():
+            return self.get(key)
+
+        def decode():
+            # Once packed, the atlas has no use for the decoded image
+            if self.surface is None:
+                loader.decode()
+
+        if hasattr(loader, 'decode'):
+            load.decode = decode
+        return load
+
+    def pack(self):
+        start = time.perf_counter()
+        images = {key: loader() for key, loader in self.loaders.items()}
+
+        # Shelf packing: fill a row left to right, then start a new row
+        # under the tallest image in it
+        x = y = row_height = 0
+        for key in sorted(images, key=lambda k: (-images[k].get_height(), k)):
+            width, height = images[key].get_size()
+            if x + width > self.width:
+                x = 0
+                y += row_height
+                row_height = 0
+            self.manifest[key] = pyg.rect.Rect(x, y, width, height)
+            x += width
+            row_height = max(row_height, height)
+
+        self.surface = pyg.Surface((self.width, y + row_height), flags=pyg.SRCALPHA).convert_alpha()
+        self.surface.fill((0, 0, 0, 0))
+        for key, rect in self.manifest.items():
+            # Copy the pixels exactly, rather than blending with the empty atlas
+            self.surface.blit(images[key], rect, special_flags=pyg.BLEND_RGBA_MAX)
+
+        load_times[self.name] = load_times.get(self.name, 0) + time.perf_counter() - start
+
+    def get(self, key):
+        if self.surface is None:
+            self.pack()
+        return self.surface.subsurface(self.manifest[key])
+
+
+def sound(*path):
+    def load():
+        return pyg.mixer.Sound(get_path(os.path.join('assets', 'audio', *path)))
+    return load
+
+def font(file, size):
+    def load():
+        return pyg.font.Font(get_path(os.path.join('assets', 'fonts', file)), size)
+    return load
+
+
+# Sprites that move around, and pieces of the world
+sprite_atlas = Atlas('sprite atlas')
+world_atlas = Atlas('world atlas')
+
+def sprite(*path):
+    return sprite_atlas.add('/'.join(path), image('sprites', *path, alpha=False))
+
+def world_image(*path):
+    return world_atlas.add('/'.join(path), image('world', *path, alpha=False))
+
+
+player_assets = AssetGroup('player', {'img_sheet': sprite('player', 'normal_sheet.png')})
+
+sounds = AssetGroup('sounds', {'score_up': sound('score_up.wav')})
+
+pickup_assets = AssetGroup('pickup', {'shadow': sprite('shadows', 'pickup.png'),
+                                      'cube': sprite('pickups', 'cube.png'),
+                                      'hp': sprite('pickups', 'hp.png')})
+
+font_files = {'apache': 'apache.ttf',
+              'coffee': 'coffee.ttf',
+              'londrina': 'Londrina.otf'}
+
+fonts = AssetGroup('fonts', {'apache32': font('apache.ttf', 32),
+                             'apache30': font('apache.ttf', 30),
+                             'coffee30': font('coffee.ttf', 30),
+                             'coffee24': font('coffee.ttf', 24),
+                             'londrina36': font('Londrina.otf', 36),
+                             'londrina40': font('Londrina.otf', 40)})
+
+def get_font(name, size):
+    """Get a font by name in any size, loading it the first time."""
+    key = f'{name}{size}'
+    if key not in fonts:
+        fonts.loaders[key] = font(font_files[name], size)
+    return fonts[key]
+
+slingshot_assets = AssetGroup('slingshot', {'slingshot': sprite('weapons', 'slingshot.png'),
+                                            'pebble': sprite('weapons', 'pebble.png')})
+
+lasergun_assets = AssetGroup('lasergun', {'lasergun': sprite('weapons', 'lasergun.png')})
+
+archer_assets = AssetGroup('archer', {'archer': sprite('archer.png'),
+                                      'arrow': sprite('arrow.png')})
+
+charger_assets = AssetGroup('charger', {'charger': sprite('charger.png')})
+
+dummy_assets = AssetGroup('dummy', {'dummy': sprite('Dummy.png')})
+
+hud_assets = AssetGroup('hud', {'hp': image('hud', 'hp.png')})
+
+world_decor_assets = AssetGroup('world_decor', {'bg_set_1': image('background', 'bg_set_1.png', alpha=False),
+                                                'bg_set_2': image('background', 'bg_set_2.png', alpha=False),
+                                                'bg_set_3': image('background', 'bg_set_3.png', alpha=False),
+                                                'bg_set_4': image('background', 'bg_set_4.png', alpha=False)})
+
+static_assets = AssetGroup('static', {'fountain': world_image('fountain.png'),
+                                      'ladder_up': world_image('ladder', 'up.png'),
+                                      'ladder_down': world_image('ladder', 'down.png')})
+
+# Every wall piece and cover, keyed by 'theme/name'. These are shared, so
+# copy one before drawing on it.
+wall_assets = AssetGroup('walls', {f'default/{name}{part}': world_image('walls', 'default', f'{name}{part}.png')
+                                   for name in ['corner', 'rl', 'ud']
+                                   for part in ['', '_top', '_bottom', '_left', '_right']})
+for corner in ['br', 'bl', 'tr', 'tl']:
+    wall_assets.loaders[f'default/corner_{corner}'] = world_image('walls', 'default', f'corner_{corner}.png')
+
+mouse_assets = AssetGroup('mouse', {'pointer': image('misc', 'mouse', 'target.png')})
+
+asset_groups = [player_assets, sounds, pickup_assets, fonts, slingshot_assets,
+                lasergun_assets, archer_assets, charger_assets, dummy_assets,
+                hud_assets, world_decor_assets, static_assets, wall_assets,
+                mouse_assets]
+
+# The groups needed to draw the first frame, loaded up front so the first
+# frame isn't slowed down by loading them one at a time
+first_frame_assets = [player_assets, sounds, pickup_assets, fonts,
+                      slingshot_assets, hud_assets, world_decor_assets,
+                      static_assets, wall_assets, mouse_assets]
+
+# The groups that levels are made from
+level_assets = [pickup_assets, archer_assets, charger_assets, dummy_assets,
+                static_assets, wall_assets]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the NRogue asset bundle')
+    parser.add_argument('--output', default=bundle.path)
+    args = parser.parse_args()
+
+    num_images = AssetBundle.build(args.output)
+    print(f'Wrote {num_images} images to {args.output}')
@@ -0,0 +1,179 @@
+"""Micro benchmarks for the parts of the game that run every frame.
+
+Runs without a window, e.g.
+    python benchmark.py blits --sprites 500 --frames 300
+    python benchmark.py env --envs 8 --frames 200
+    python benchmark.py grid --frames 1000
+    python benchmark.py net --frames 1000 --latency 4
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame as pyg
+
+import environment
+import main
+import netplay
+
+
+class BenchSprite(main.StaticObject):
+    def __init__(self, window, image, pos):
+        self.image = image
+        super().__init__(window, pos, False)
+
+
+def bench_blits(num_sprites, frames, size=(1920, 1080)):
+    """Compare drawing a layer with one render() call per sprite against
+    drawing it with LayerRenderer. Every sprite is on screen."""
+    pyg.display.init()
+    window = pyg.display.set_mode(size)
+
+    images = []
+    for w, h in [(12, 12), (30, 25), (40, 40), (50, 50), (75, 75), (150, 75)]:
+        image = pyg.Surface((w, h), flags=pyg.SRCALPHA).convert_alpha()
+        image.fill((random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), 200))
+        images.append(image)
+
+    sprites = pyg.sprite.Group()
+    for i in range(num_sprites):
+        pos = (random.randint(0, size[0] - 150), random.randint(0, size[1] - 75))
+        sprites.add(BenchSprite(window, random.choice(images), pos))
+
+    renderer = main.LayerRenderer(window)
+
+    start = time.perf_counter()
+    for i in range(frames):
+        for s in sprites:
+            s.render()
+    per_sprite = (time.perf_counter() - start) / frames
+
+    start = time.perf_counter()
+    for i in range(frames):
+        renderer.render(sprites)
+    batched = (time.perf_counter() - start) / frames
+
+    print(f'blits: {num_sprites} sprites, {frames} frames')
+    print(f'  render() per sprite: {per_sprite * 1000:.3f} ms/frame')
+    print(f'  LayerRenderer:       {batched * 1000:.3f} ms/frame')
+    print(f'  speedup:             {per_sprite / batched:.2f}x')
+
+    pyg.display.quit()
+
+
+def bench_env(num_envs, frames, seed):
+    """Steps per second of a VectorEnv with random actions, for one worker
+    and then for more, up to one per core."""
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= min(os.cpu_count(), num_envs):
+        worker_counts.append(worker_counts[-1] * 2)
+
+    print(f'env: {num_envs} games, {frames} steps each, {os.cpu_count()} cores')
+    base = None
+    for workers in worker_counts:
+        envs = environment.VectorEnv(num_envs, seed, workers)
+        envs.reset()
+
+        start = time.perf_counter()
+        for i in range(frames):
+            for j in range(num_envs * environment.action_size):
+                envs.actions[j] = random.uniform(-1, 1)
+            envs.step()
+        rate = num_envs * frames / (time.perf_counter() - start)
+        envs.close()
+
+        base = base or rate
+        print(f'  {workers:>2} workers: {rate:8.0f} steps/s  ({rate / base:.2f}x)')
+
+
+def bench_grid(frames, seed):
+    """Time GridEncoder.encode() against a step of the game it encodes."""
+    env = environment.NRogueEnv(seed)
+    env.reset()
+    encoder = environment.GridEncoder()
+    out = encoder.new_buffer()
+
+    step_time = encode_time = 0
+    for i in range(frames):
+        action = [random.choice([-1, 0, 1]), random.choice([-1, 0, 1]), 1, random.uniform(-3, 3), 0]
+        start = time.perf_counter()
+        env.step(action)
+        step_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        encoder.encode(env.world, env.player, out)
+        encode_time += time.perf_counter() - start
+
+    print(f'grid: {encoder.shape} cells, {frames} steps')
+    print(f'  step:   {step_time / frames * 1e6:8.1f} us')
+    print(f'  encode: {encode_time / frames * 1e6:8.1f} us')
+
+
+def bench_net(frames, seed, latency):
+    """Bandwidth and time per tick of netplay snapshots, for a client whose
+    acks reach the server latency ticks late, against sending the whole
+    state every tick. Runs in one process, so the socket isn't timed."""
+    sim = netplay.Simulation(seed)
+    states = {}
+    acks = []
+    acked = 0
+
+    full_bytes = delta_bytes = 0
+    full_time = decode_time = 0
+    for i in range(frames):
+        action = [random.choice([-1, 0, 1]), random.choice([-1, 0, 1]), random.random() < .2,
+                  random.uniform(-3, 3), 0]
+        sim.step(action)
+
+        start = time.perf_counter()
+        full = netplay.encode(sim.tick, sim.state)
+        full_time += time.perf_counter() - start
+        full_bytes += netplay.message_header.size + len(full)
+
+        snapshot = sim.snapshot(acked)
+        delta_bytes += netplay.message_header.size + len(snapshot)
+
+        start = time.perf_counter()
+        tick, state = netplay.decode(snapshot, states)
+        decode_time += time.perf_counter() - start
+        states[tick] = state
+        states.pop(tick - netplay.history, None)
+
+        acks.append(tick)
+        if len(acks) > latency:
+            acked = acks.pop(0)
+
+    per_second = main.FPS / frames / 1024
+    print(f'net: {frames} ticks, acks {latency} ticks late')
+    print(f'  capture:         {sim.capture_time / sim.tick * 1e6:8.1f} us/tick')
+    print(f'  encode full:     {full_time / frames * 1e6:8.1f} us/tick'
+          f'  {full_bytes / frames:8.1f} bytes/tick  {full_bytes * per_second:7.1f} KiB/s')
+    print(f'  encode delta:    {sim.encode_time / sim.num_encoded * 1e6:8.1f} us/tick'
+          f'  {delta_bytes / frames:8.1f} bytes/tick  {delta_bytes * per_second:7.1f} KiB/s')
+    print(f'  decode delta:    {decode_time / frames * 1e6:8.1f} us/tick')
+    print(f'  bandwidth saved: {1 - delta_bytes / full_bytes:8.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=['blits', 'env', 'grid', 'net'])
+    parser.add_argument('--sprites', type=int, default=500)
+    parser.add_argument('--envs', type=int, default=8)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=int, default=4, help='ticks before the server gets an ack')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    if args.benchmark == 'blits':
+        bench_blits(args.sprites, args.frames)
+    elif args.benchmark == 'env':
+        bench_env(args.envs, args.frames, args.seed)
+    elif args.benchmark == 'grid':
+        bench_grid(args.frames, args.seed)
+    elif args.benchmark == 'net':
+        bench_net(args.frames, args.seed, args.latency)
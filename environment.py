@@ -0,0 +1,391 @@
+"""Run NRogue without a window, one tick at a time, for bots to play.
+
+NRogueEnv is a single game with reset() and step(). VectorEnv runs many of
+them in worker processes, sharing observations, actions and rewards with
+them through shared memory, so each game gets its own core. GridEncoder
+turns the area around the player into a NumPy array.
+"""
+import math
+import multiprocessing
+import os
+import random
+
+import numpy as np
+import pygame as pyg
+
+import main
+
+
+# Actions are five floats:
+#   move x, move y  -1, 0 or 1, like holding the arrow keys
+#   fire            fire the weapon if above .5
+#   aim             the angle to aim at, in radians
+#   interact        use a ladder if above .5, like pressing 'F'
+action_size = 5
+
+# Observations are floats, roughly between -1 and 1:
+#   the player      x, y, hp, velocity x, y, has crystal, level
+#   ladders         distance to the down ladder (or crystal) and up ladder
+#   nearest enemies, enemy bullets and pickups
+#                   distance x, y and 1 for each, or zeros if there are fewer
+#   walls           a square of tiles around the player, 1 if walkable
+num_nearest = 4
+view_tiles = 7
+obs_size = 7 + 4 + 3 * 3 * num_nearest + view_tiles * view_tiles
+
+# How far away things are scaled by, in pixels
+view_range = 1000
+
+
+def init_headless(size=(640, 480)):
+    """Set up pygame and the game's globals without a window or sound.
+    Only the first call does anything."""
+    if pyg.display.get_init():
+        return
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pyg.display.init()
+    pyg.font.init()
+    main.setup(pyg.display.set_mode(size))
+
+
+class NRogueEnv():
+    def __init__(self, seed=None, max_ticks=main.FPS * 60 * 5, reward_weights=(.01, 1, 10)):
+        """One game that moves on a tick each time step() is called. The
+        reward is the score gained, minus the damage taken, plus the number
+        of levels deeper than ever before, weighted by reward_weights. The
+        game ends if the player dies, wins, or after max_ticks.
+
+        Every game has its own random numbers, so games seeded the same play
+        out the same even when many share a process."""
+        init_headless()
+        self.max_ticks = max_ticks
+        self.reward_weights = reward_weights
+
+        self.random_state = random.Random(seed).getstate()
+        self.world = None
+
+    def reset(self, seed=None, out=None):
+        """Start a new game and return the first observation. Without a
+        seed, the next game follows on from the random numbers of the last.
+        If out is given, the observation is written into it."""
+        if seed is not None:
+            self.random_state = random.Random(seed).getstate()
+        random.setstate(self.random_state)
+
+        self.level = 1
+        self.deepest = 1
+        self.ticks = 0
+        self.won = False
+
+        self.world = main.World(main.window)
+        self.world.generate(self.level, 'nodir')
+        self.player = main.Player(main.window, self.world)
+        self.player.rect.center = self.world.spawn
+        self.player.add_hud(main.HUD(main.window, self.player, self.level))
+        main.camera.follow(self.player)
+        main.camera.apply_lens(self.player, self.world, None)
+
+        self.random_state = random.getstate()
+        return self.observe(out)
+
+    def step(self, action, out=None):
+        """Play one tick with action, see action_size. Returns the
+        observation, reward, whether the game is over, and a dict with the
+        parts of the reward."""
+        random.setstate(self.random_state)
+        world = self.world
+        player = self.player
+        move_x, move_y, fire, aim, interact = action
+
+        score = player.score
+        hp = player.hp
+
+        # The camera is shared by every game in the process, and firing goes
+        # through it, so point it at this game before anything else
+        main.camera.follow(player)
+        main.camera.apply_lens(player, world, None)
+        if interact > .5 and self.use_ladder():
+            main.camera.follow(player)
+            main.camera.apply_lens(player, world, None)
+
+        # Aim by putting the mouse on a circle around the player
+        main.controls.mouse_pos = (int(player.draw_rect.centerx + math.cos(aim) * 200),
+                                   int(player.draw_rect.centery + math.sin(aim) * 200))
+        if fire > .5:
+            player.fire()
+        if move_x:
+            player.vel.x += player.speed * math.copysign(1, move_x)
+        if move_y:
+            player.vel.y += player.speed * math.copysign(1, move_y)
+
+        main.update_world(world, player)
+        self.ticks += 1
+
+        damage = hp - player.hp
+        depth = max(self.level - self.deepest, 0)
+        self.deepest = max(self.level, self.deepest)
+        info = {'score': player.score - score, 'damage': damage, 'depth': depth, 'won': self.won}
+        reward = (info['score'] * self.reward_weights[0] - damage * self.reward_weights[1] +
+                  depth * self.reward_weights[2])
+        done = player.hp <= 0 or not player.is_alive or self.won or self.ticks >= self.max_ticks
+
+        self.random_state = random.getstate()
+        return self.observe(out), reward, done, info
+
+    def use_ladder(self):
+        """The same as pressing 'F' in the game. Returns True if the player
+        was moved to another level."""
+        world = self.world
+        player = self.player
+        if player.collide_rect.colliderect(world.up_ladder.rect):
+            if self.level == 1:
+                self.won = player.has_crystal
+                return False
+            world.save_level(self.level)
+            self.level -= 1
+            world.generate(self.level, 'up')
+        elif world.down_ladder is not None and player.collide_rect.colliderect(world.down_ladder.rect):
+            world.save_level(self.level)
+            self.level += 1
+            world.generate(self.level, 'down')
+        else:
+            return False
+        player.rect.center = world.spawn
+        return True
+
+    def observe(self, out=None):
+        """Write the observation into out, or a new list, and return it.
+        out can be anything that floats can be assigned to by index, e.g. a
+        slice of a memoryview."""
+        if out is None:
+            out = [0.0] * obs_size
+        world = self.world
+        player = self.player
+        px, py = player.rect.center
+
+        values = [px / world.rect.width, py / world.rect.height,
+                  player.hp / player.max_hp, player.vel.x / player.speed, player.vel.y / player.speed,
+                  float(player.has_crystal), self.level / 10]
+
+        goal = world.down_ladder or world.crystal
+        for thing in [goal, world.up_ladder]:
+            if thing is None:
+                values += [0.0, 0.0]
+            else:
+                values += [(thing.rect.centerx - px) / view_range, (thing.rect.centery - py) / view_range]
+
+        area = pyg.rect.Rect(0, 0, 2 * view_range, 2 * view_range)
+        area.center = (px, py)
+        groups = [world.enemies,
+                  [b for b in world.bullets if b.owner != 'player'],
+                  world.pickup_index.query(area)]
+        for group in groups:
+            nearest = sorted(((s.rect.centerx - px, s.rect.centery - py) for s in group),
+                             key=lambda d: (d[0]*d[0] + d[1]*d[1], d))[:num_nearest]
+            for dx, dy in nearest:
+                values += [dx / view_range, dy / view_range, 1.0]
+            values += [0.0] * (3 * (num_nearest - len(nearest)))
+
+        tx, ty = px // world.tile_size, py // world.tile_size
+        half = view_tiles // 2
+        for y in range(ty - half, ty + half + 1):
+            for x in range(tx - half, tx + half + 1):
+                if 0 <= x < world.grid_w and 0 <= y < world.grid_h:
+                    values.append(float(world.walkable[y * world.grid_w + x]))
+                else:
+                    values.append(0.0)
+
+        for i, value in enumerate(values):
+            out[i] = value
+        return out
+
+
+def run_worker(conn, envs, shared, env_kwargs):
+    """The loop of a VectorEnv worker process. envs is a list of (index,
+    seed) for the games it runs, and shared the arrays they all use."""
+    observations, actions, rewards, dones = [memoryview(array).cast('B').cast(format)
+                                             for array, format in zip(shared, 'fffB')]
+    games = [(i, NRogueEnv(seed, **env_kwargs)) for i, seed in envs]
+
+    def obs_slice(i):
+        return observations[i * obs_size:(i + 1) * obs_size]
+
+    while True:
+        command = conn.recv()
+        if command == 'reset':
+            for i, game in games:
+                game.reset(out=obs_slice(i))
+                rewards[i] = 0
+                dones[i] = 0
+        elif command == 'step':
+            for i, game in games:
+                action = actions[i * action_size:(i + 1) * action_size].tolist()
+                obs, reward, done, info = game.step(action, out=obs_slice(i))
+                rewards[i] = reward
+                dones[i] = int(done)
+                # Start the next game straight away, the done flag says the
+                # observation is from a new one
+                if done:
+                    game.reset(out=obs_slice(i))
+        elif command == 'close':
+            conn.send(None)
+            return
+        conn.send(None)
+
+
+class VectorEnv():
+    def __init__(self, num_envs, seed=0, workers=None, **env_kwargs):
+        """num_envs games split across worker processes, by default one per
+        core. Game i is seeded with seed + i. Observations, actions, rewards
+        and done flags are shared memory arrays, flat and in game order, so
+        e.g. the observation of game i starts at i * obs_size. Nothing but
+        short commands is sent between processes."""
+        self.num_envs = num_envs
+        workers = min(workers or os.cpu_count(), num_envs)
+
+        # Spawn rather than fork, so no worker inherits pygame's state
+        context = multiprocessing.get_context('spawn')
+        self.observations = context.RawArray('f', num_envs * obs_size)
+        self.actions = context.RawArray('f', num_envs * action_size)
+        self.rewards = context.RawArray('f', num_envs)
+        self.dones = context.RawArray('B', num_envs)
+        shared = (self.observations, self.actions, self.rewards, self.dones)
+
+        self.conns = []
+        self.processes = []
+        for w in range(workers):
+            envs = [(i, seed + i) for i in range(w, num_envs, workers)]
+            conn, worker_conn = context.Pipe()
+            process = context.Process(target=run_worker, args=(worker_conn, envs, shared, env_kwargs),
+                                      daemon=True)
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def send(self, command):
+        for conn in self.conns:
+            conn.send(command)
+        for conn in self.conns:
+            conn.recv()
+
+    def reset(self):
+        """Start every game again, and return the observations."""
+        self.send('reset')
+        return self.observations
+
+    def step(self, actions=None):
+        """Play a tick of every game. actions is a flat sequence of every
+        game's action, or None if they were already written to
+        self.actions. Games that finish start again by themselves. Returns
+        the observations, rewards and done flags."""
+        if actions is not None:
+            self.actions[:] = actions
+        self.send('step')
+        return self.observations, self.rewards, self.dones
+
+    def close(self):
+        self.send('close')
+        for process in self.processes:
+            process.join()
+
+
+class GridEncoder():
+    # One layer of the output for each of these, in this order
+    channels = ['wall', 'fog', 'player',
+                'crystal', 'archer', 'charger', 'dummy',
+                'player_bullet', 'enemy_bullet',
+                'cube', 'hp']
+
+    def __init__(self, size=48, cell_size=25):
+        """Describes the size x size cells around the player as an array of
+        shape (channels, size, size), where a cell is 1 if something of
+        that channel covers it. It is read straight from the world instead
+        of drawing anything. Walls come from the tile grid, fog from the
+        rooms, pickups from their spatial index, and enemies and bullets
+        from their groups. Cells line up with the tiles, so cell_size must
+        divide the tile size."""
+        self.size = size
+        self.cell_size = cell_size
+        self.shape = (len(self.channels), size, size)
+        self.index = {name: i for i, name in enumerate(self.channels)}
+
+        # The walls and fog of the whole level at cell resolution, kept
+        # until they change
+        self.opaque = None
+        self.wall_cells = None
+        self.fog_mask = None
+        self.fog_cells = None
+
+    def new_buffer(self, dtype=None):
+        return np.zeros(self.shape, dtype or np.float32)
+
+    def encode(self, world, player, out):
+        """Write the cells around the player into out, an array of
+        self.shape, and return it. Nothing else is allocated."""
+        size = self.size
+        cell = self.cell_size
+        # The cell in the top left of the view
+        x0 = player.rect.centerx // cell - size // 2
+        y0 = player.rect.centery // cell - size // 2
+        view = pyg.rect.Rect(x0 * cell, y0 * cell, size * cell, size * cell)
+
+        out[...] = 0
+        self.copy_area(self.get_wall_cells(world), out[self.index['wall']], x0, y0, 1)
+        self.copy_area(self.get_fog_cells(world), out[self.index['fog']], x0, y0, 0)
+
+        self.fill_rect(out[self.index['player']], player.rect, x0, y0)
+
+        # Not the AI's tiers, which are empty until its first update after
+        # a level change and only re-sorted once a second
+        for enemy in world.enemies:
+            if enemy.rect.colliderect(view):
+                self.fill_rect(out[self.index[type(enemy).__name__.lower()]], enemy.rect, x0, y0)
+
+        for bullet in world.bullets:
+            channel = 'player_bullet' if bullet.owner == 'player' else 'enemy_bullet'
+            self.fill_rect(out[self.index[channel]], bullet.rect, x0, y0)
+
+        for pickup in world.pickup_index.query(view):
+            self.fill_rect(out[self.index[pickup.type]], pickup.rect, x0, y0)
+
+        return out
+
+    def get_wall_cells(self, world):
+        if world.opaque is not self.opaque:
+            scale = world.tile_size // self.cell_size
+            tiles = np.frombuffer(world.opaque, dtype=np.uint8).reshape(world.grid_h, world.grid_w)
+            self.wall_cells = tiles.repeat(scale, axis=0).repeat(scale, axis=1)
+            self.opaque = world.opaque
+        return self.wall_cells
+
+    def get_fog_cells(self, world):
+        cols = world.rect.width // world.room_size[0]
+        mask = tuple(any(fog.alive() for fog in room.fogs) for room in world.rooms)
+        if mask != self.fog_mask or self.fog_cells is None:
+            rooms = np.array(mask, dtype=np.uint8).reshape(-1, cols)
+            self.fog_cells = (rooms.repeat(world.room_size[1] // self.cell_size, axis=0)
+                                   .repeat(world.room_size[0] // self.cell_size, axis=1))
+            self.fog_mask = mask
+        return self.fog_cells
+
+    def copy_area(self, source, out, x0, y0, outside):
+        """Copy the part of source under the view into out. Cells of the
+        view outside of source are set to outside."""
+        size = self.size
+        height, width = source.shape
+        left, top = max(x0, 0), max(y0, 0)
+        right, bottom = min(x0 + size, width), min(y0 + size, height)
+        if outside:
+            out[...] = outside
+        if left < right and top < bottom:
+            out[top - y0:bottom - y0, left - x0:right - x0] = source[top:bottom, left:right]
+
+    def fill_rect(self, out, rect, x0, y0):
+        """Set every cell of out that rect covers to 1."""
+        cell = self.cell_size
+        left = max(rect.left // cell - x0, 0)
+        top = max(rect.top // cell - y0, 0)
+        right = min((rect.right - 1) // cell + 1 - x0, self.size)
+        bottom = min((rect.bottom - 1) // cell + 1 - y0, self.size)
+        if left < right and top < bottom:
+            out[top:bottom, left:right] = 1
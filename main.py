@@ -1,8 +1,20 @@
+import time
+start_time = time.perf_counter()
+
 import pygame as pyg
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
 import random
 import math
 import os
 
+# Assets are only loaded when first used, so this is safe before pygame is
+# initialised
+from asset_loader import *
+import replay
+import savegame
+
 
 os.environ['SDL_VIDEO_CENTERED'] = '1'
 
@@ -17,8 +29,11 @@ class Player(pyg.sprite.Sprite):
         self.sheet = player_assets['img_sheet']
         self.image_rect_dict = {'right': pyg.rect.Rect(0, 0, 50, 60),
                                 'left':  pyg.rect.Rect(50, 0, 50, 60)}
+        # Views into the sheet, so changing image doesn't copy any pixels
+        self.images = {name: self.sheet.subsurface(rect)
+                       for name, rect in self.image_rect_dict.items()}
 
-        self.image = pyg.Surface((50, 60), flags=pyg.SRCALPHA)
+        self.image = self.images['right']
 
         self.rect = self.image.get_rect()
 
@@ -44,8 +59,6 @@ class Player(pyg.sprite.Sprite):
 
         self.i_frames_left = 0 # Invincibility frames
 
-        self.score_sound = player_assets['score_sound']
-
         self.has_crystal = False
 
     def add_hud(self, hud):
@@ -53,7 +66,14 @@ class Player(pyg.sprite.Sprite):
         self.hud = hud
 
     def move_x(self, amount):
-        self.rect.x += int(amount)
+        amount = int(amount)
+        if not self.free_move: # Cheat code
+            # Stop against the first wall in the way, however far we move
+            toi, normal, wall = self.world.sweep(self.rect, amount, 0)
+            if wall is not None:
+                amount = round(amount * toi)
+                self.vel.x = 0
+        self.rect.x += amount
 
          # Edges of the screen
         if self.rect.right > self.world.rect.width:
@@ -63,20 +83,14 @@ class Player(pyg.sprite.Sprite):
             self.rect.left = 0
             self.vel.x = 0
 
-        if not self.free_move: # Cheat code
-            obstacles = self.world.walls.sprites() + self.world.statics.sprites()
-
-            for wall in obstacles:
-                if self.rect.colliderect(wall.collide_rect):
-                    if self.vel.x > 0:
-                        self.rect.right = wall.collide_rect.left
-                        self.vel.x = 0
-                    elif self.vel.x < 0:
-                        self.rect.left = wall.collide_rect.right
-                        self.vel.x = 0
-
     def move_y(self, amount):
-        self.rect.y += int(amount)
+        amount = int(amount)
+        if not self.free_move:
+            toi, normal, wall = self.world.sweep(self.rect, 0, amount)
+            if wall is not None:
+                amount = round(amount * toi)
+                self.vel.y = 0
+        self.rect.y += amount
 
          # Edges of the screen
         if self.rect.top < 0:
@@ -86,17 +100,22 @@ class Player(pyg.sprite.Sprite):
             self.rect.bottom = self.world.rect.height
             self.vel.y = 0
 
-        if not self.free_move:
-            obstacles = self.world.walls.sprites() + self.world.statics.sprites()
-
-            for wall in obstacles:
-                if self.rect.colliderect(wall.collide_rect):
-                    if self.vel.y < 0:
-                        self.rect.top = wall.collide_rect.bottom
-                        self.vel.y = 0
-                    elif self.vel.y > 0:
-                        self.rect.bottom = wall.collide_rect.top
-                        self.vel.y = 0
+    def snapshot(self):
+        return {'score': self.score,
+                'hp': self.hp,
+                'max_hp': self.max_hp,
+                'has_crystal': self.has_crystal,
+                'weapon': 'lasergun' if isinstance(self.cur_weapon, LaserGun) else 'slingshot',
+                'pos': self.rect.center}
+
+    def restore(self, data):
+        self.score = data['score']
+        self.hp = data['hp']
+        self.max_hp = data['max_hp']
+        self.has_crystal = data['has_crystal']
+        if data['weapon'] == 'lasergun':
+            self.cur_weapon = LaserGun(self.window, self.world)
+        self.rect.center = data['pos']
 
     def collect_crystal(self):
         self.has_crystal = True
@@ -109,6 +128,7 @@ class Player(pyg.sprite.Sprite):
                 pickup.kill()
         elif pickup.type == 'cube':
             self.add_score(pickup.amount)
+            self.world.particles.emit(pickup.rect.center, 'sparkle', 10)
             pickup.kill()
             self.hud.update('score')
 
@@ -144,13 +164,12 @@ class Player(pyg.sprite.Sprite):
     def add_score(self, amount):
         """Update the score then update the hud."""
         self.score += amount
-        play_sound(self.score_sound)
+        sound_manager.play('score_up')
         self.hud.update('score')
 
     def set_image(self, img):
         """Change the image for the player."""
-        self.image.fill((0, 0, 0, 0))
-        self.image.blit(self.sheet, (0, 0), self.image_rect_dict[img])
+        self.image = self.images[img]
         # Uncomment when testing one image
         #self.image = pyg.image.load(get_path(os.path.join('assets', 'imgs', 'sprites', 'player', 'block', 'test.png'))).convert_alpha()
 
@@ -178,11 +197,16 @@ class Player(pyg.sprite.Sprite):
                 if self.collide_rect.colliderect(bullet.rect):
                     self.hurt(1)
                     bullet.kill()
-        for pickup in self.world.pickups:
-            if self.collide_rect.colliderect(pickup.rect):
-                self.apply_pickup(pickup)
-
-        if pyg.mouse.get_pos()[0] > WIDTH//2:
+        touching = {pickup for pickup in self.world.pickup_index.query(self.collide_rect)
+                    if self.collide_rect.colliderect(pickup.rect)}
+        if touching:
+            # The index is unordered, so go through the group to pick them up
+            # in the same order every run
+            for pickup in self.world.pickups.sprites():
+                if pickup in touching:
+                    self.apply_pickup(pickup)
+
+        if get_mouse_pos()[0] > WIDTH//2:
             self.set_image('right')
         else:
             self.set_image('left')
@@ -207,7 +231,7 @@ class Pickup(pyg.sprite.Sprite):
         super().__init__()
         self.window = window
         self.window_rect = self.window.get_rect()
-        self.image = data['image'].convert_alpha()
+        self.image = data['image']
         self.shadow = pickup_assets['shadow']
         self.rect = self.image.get_rect()
         self.rect.topleft = data['pos']
@@ -216,36 +240,14 @@ class Pickup(pyg.sprite.Sprite):
         self.vel = pyg.Vector2()
 
         self.type = data['type']
-        if self.type in ['cube']:
-            self.seek_player = True
+        # Health is only pulled in while the player is hurt, which is
+        # decided by World.update_pickups()
+        self.seek_player = self.type in ['cube']
 
         self.amount = 100
 
         self.on_ground = True
 
-    def update(self, player):
-        if self.type == 'hp':
-            if player.hp == player.max_hp:
-                self.seek_player = False
-            else:
-                self.seek_player = True
-
-        # Distance but no sqrt so it's faster
-        dist = ((self.rect.centerx - player.rect.centerx)**2 +
-                (self.rect.centery - player.rect.centery)**2)
-        if dist < 10000 and self.seek_player:
-            dir = math.atan2((player.rect.center[1] - self.rect.center[1]),
-                             (player.rect.center[0] - self.rect.center[0]))
-
-            self.vel.x += math.cos(dir)
-            self.vel.y += math.sin(dir)
-
-            self.rect.x += int(self.vel.x) * 5
-            self.rect.y += int(self.vel.y) * 5
-        else:
-            self.vel.x *= .5
-            self.vel.y *= .5
-
     def render(self):
         if self.on_ground:
             if self.draw_rect.colliderect(self.window_rect):
@@ -262,10 +264,7 @@ class Textbox():
         self.texts = []
         self.rects = []
 
-        if font == 'apache':
-            self.font = pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'apache.ttf')), size)
-        elif font == 'coffee':
-            self.font = pyg.font.Font(get_path(os.path.join('assets', 'fonts', 'coffee.ttf')), size)
+        self.font = get_font(font, size)
 
         for line in text_lines:
             text = self.font.render(line, True, (0, 0, 0))
@@ -364,21 +363,20 @@ class Slingshot():
                             'rect': self.b_rect,
                             'owner': 'player',
                             'source': (self.rect.centerx, self.rect.y),
-                            'target': camera.get_world_pos(pyg.mouse.get_pos()),
+                            'target': camera.get_world_pos(get_mouse_pos()),
                             'speed': 40,
                             'invulnerable': False,
                             'bouncy': False}
 
     def fire(self):
         self.bullet_data['source'] = (self.rect.centerx, self.rect.y)
-        self.bullet_data['target'] = camera.get_world_pos(pyg.mouse.get_pos())
+        self.bullet_data['target'] = camera.get_world_pos(get_mouse_pos())
 
-        bullet = Bullet(self.window, self.world, self.bullet_data)
-        self.world.bullets.add(bullet)
+        self.world.bullets.spawn(self.bullet_data)
 
     def set_pos(self, p_rect):
         # Rotate towards the mouse pointer
-        m_pos = pyg.mouse.get_pos()
+        m_pos = get_mouse_pos()
 
         dir = math.atan2((m_pos[1] - p_rect.centery), (m_pos[0] - p_rect.centerx))
         x = math.cos(dir)
@@ -445,7 +443,7 @@ class LaserGun():
 
     def set_pos(self, p_rect):
         # Rotate towards the mouse pointer
-        m_pos = pyg.mouse.get_pos()
+        m_pos = get_mouse_pos()
 
         dir = math.atan2((m_pos[1] - p_rect.centery), (m_pos[0] - p_rect.centerx))
         x = math.cos(dir)
@@ -479,7 +477,7 @@ class LaserGun():
         self.window.blit(self.image, self.rect)
 
 
-class Bullet(pyg.sprite.Sprite):
+class Bullet():
     """
          XXXXXXXXXXXX
          XXXX      XXXX
@@ -491,68 +489,136 @@ class Bullet(pyg.sprite.Sprite):
 
     Minimap label
     """
-    def __init__(self, window, world, data):
-        super().__init__()
+    # Bullets are recycled by a BulletPool instead of being created and
+    # destroyed, so keep them as small fixed records
+    __slots__ = ('window', 'world', 'pool', 'index', 'is_alive', 'owner',
+                 'image', 'rect', 'draw_rect', 'speed', 'invulnerable',
+                 'bouncy', 'num_bounce', 'kill_next_frame', 'vel')
+
+    def __init__(self, window, world, pool, index):
         self.window = window
         self.world = world
+        self.pool = pool
+        self.index = index
 
-        self.data = data
+        self.is_alive = False
+
+        self.rect = pyg.rect.Rect(0, 0, 0, 0)
+        self.draw_rect = self.rect
+        self.vel = pyg.Vector2()
+
+    def spawn(self, data):
+        """Reset this bullet from a bullet_data dict. Called by the pool."""
+        self.is_alive = True
 
-        self.owner = self.data['owner']
+        self.owner = data['owner']
 
-        self.image = self.data['image']
-        self.rect = self.data['rect'].copy()
-        self.rect.center = camera.get_world_pos(self.data['source'])
+        self.image = data['image']
+        self.rect.size = data['rect'].size
+        self.rect.center = camera.get_world_pos(data['source'])
         self.draw_rect = self.rect
 
-        self.speed = self.data['speed']
+        self.speed = data['speed']
 
-        self.invulnerable = self.data['invulnerable']
-        self.bouncy = self.data['bouncy']
+        self.invulnerable = data['invulnerable']
+        self.bouncy = data['bouncy']
         if self.bouncy:
-            self.num_bounce = self.data['num_bounce']
+            self.num_bounce = data['num_bounce']
 
         self.kill_next_frame = False
 
-        self.vel = pyg.Vector2()
-        target = self.data['target']
+        target = data['target']
         dir = math.atan2((target[1] - self.rect.centery), (target[0] - self.rect.centerx))
         # A number in the range (-1, 1), multiplied by speed to move each tick
         self.vel.x = math.cos(dir)
         self.vel.y = math.sin(dir)
 
+    def kill(self):
+        """Give the bullet back to the pool it came from."""
+        self.pool.release(self)
+
+    def alive(self):
+        return self.is_alive
+
     def update(self):
         if self.kill_next_frame == True:
             self.kill()
+            return
 
-        self.rect.x += int(self.vel.x * self.speed)
-        self.rect.y += int(self.vel.y * self.speed)
-
-        for wall in self.world.walls:
-             # Don't use wall.collide_rect so bullet collisions seem fair
-            if self.rect.colliderect(wall.rect):
-                if self.bouncy and self.num_bounce > 0:
-                        if self.vel.x > 0:
-                            self.rect.right = wall.rect.left
-                            self.vel.x *= -1
-                        elif self.vel.x < 0:
-                            self.rect.left = wall.rect.right
-                            self.vel.x *= -1
-
-                        if self.vel.y < 0:
-                            self.rect.top = wall.rect.bottom
-                            self.vel.y *= -1
-                        elif self.vel.y > 0:
-                            self.rect.bottom = wall.rect.top
-                            self.vel.y *= -1
+        dx = int(self.vel.x * self.speed)
+        dy = int(self.vel.y * self.speed)
+        # Don't use wall.collide_rect so bullet collisions seem fair. The
+        # whole move is swept, so fast bullets can't skip through a wall.
+        toi, normal, wall = self.world.sweep(self.rect, dx, dy, walls_only=True)
+        self.rect.x += round(dx * toi)
+        self.rect.y += round(dy * toi)
+
+        if self.owner == 'enemy':
+            self.world.particles.emit(self.rect.center, 'trail', 1)
+
+        if wall is not None:
+            if self.bouncy and self.num_bounce > 0:
+                # Reflect off the side that was hit
+                if normal[0]:
+                    self.vel.x *= -1
                 else:
-                    self.kill_next_frame = True
+                    self.vel.y *= -1
+            else:
+                self.kill_next_frame = True
+                back = math.atan2(-self.vel.y, -self.vel.x)
+                self.world.particles.emit(self.rect.center, 'spark', 6, back, math.pi/3)
 
     def render(self):
         if self.draw_rect.colliderect(self.world.rect):
             self.window.blit(self.image, self.draw_rect)
 
 
+class BulletPool():
+    def __init__(self, window, world, capacity=256):
+        """A fixed number of Bullet records that get reused. Free records
+        are kept on a stack, and live ones in a dict so that spawning and
+        killing are both O(1). The dict keeps the order bullets were spawned
+        in, so when the pool is full the oldest bullet is taken back.
+
+        The pool can be iterated like the sprite group it replaces."""
+        self.capacity = capacity
+        self.bullets = [Bullet(window, world, self, i) for i in range(capacity)]
+        self.free = list(range(capacity - 1, -1, -1))
+        self.active = {}
+
+    def spawn(self, data):
+        """Take a free bullet (or the oldest live one) and fire it."""
+        if not self.free:
+            oldest = next(iter(self.active.values()))
+            self.release(oldest)
+
+        bullet = self.bullets[self.free.pop()]
+        bullet.spawn(data)
+        self.active[bullet.index] = bullet
+
+        return bullet
+
+    def release(self, bullet):
+        if bullet.is_alive:
+            bullet.is_alive = False
+            del self.active[bullet.index]
+            self.free.append(bullet.index)
+
+    def empty(self):
+        for bullet in self.sprites():
+            self.release(bullet)
+
+    def sprites(self):
+        return list(self.active.values())
+
+    def __iter__(self):
+        # Iterate over a copy because bullets are killed while looping
+        return iter(self.sprites())
+
+    def __len__(self):
+        return len(self.active)
+
+
 class Enemy(pyg.sprite.Sprite):
     """
          XXXXXXXXXXXXX
@@ -576,54 +642,43 @@ class Enemy(pyg.sprite.Sprite):
 
         self.vel = pyg.Vector2((0, 0))
 
-    def move_x(self, amount):
-        self.rect.x += int(amount)
-
-        obstacles = self.world.walls.sprites() + self.world.statics.sprites()
+        # How many ticks this update stands in for, set by the AIScheduler
+        self.step = 1
 
-        for wall in obstacles:
-            if self.rect.colliderect(wall.collide_rect):
-                if self.vel.x > 0:
-                    self.rect.right = wall.collide_rect.left
-                    self.vel.x = 0
-                elif self.vel.x < 0:
-                    self.rect.left = wall.collide_rect.right
-                    self.vel.x = 0
+    def move_x(self, amount):
+        amount = int(amount)
+        toi, normal, wall = self.world.sweep(self.rect, amount, 0)
+        if wall is not None:
+            amount = round(amount * toi)
+            self.vel.x = 0
+        self.rect.x += amount
 
     def move_y(self, amount):
-        self.rect.y += int(amount)
-
-        obstacles = self.world.walls.sprites() + self.world.statics.sprites()
-
-        for wall in obstacles:
-            if self.rect.colliderect(wall.collide_rect):
-                if self.vel.y < 0:
-                    self.rect.top = wall.collide_rect.bottom
-                    self.vel.y = 0
-                elif self.vel.y > 0:
-                    self.rect.bottom = wall.collide_rect.top
-                    self.vel.y = 0
+        amount = int(amount)
+        toi, normal, wall = self.world.sweep(self.rect, 0, amount)
+        if wall is not None:
+            amount = round(amount * toi)
+            self.vel.y = 0
+        self.rect.y += amount
 
     def die(self):
+        self.world.particles.emit(self.rect.center, 'death', 16)
         self.kill()
         # player.add_score(self.score)
 
+    def hurt(self, amount):
+        """Called by World.hit_enemies() every tick, even for enemies that
+        the AIScheduler has asleep."""
+        self.hp -= amount
+        if self.hp <= 0:
+            self.die()
+
     def update(self):
-        self.move_x(self.vel.x)
-        self.move_y(self.vel.y)
+        self.move_x(self.vel.x * self.step)
+        self.move_y(self.vel.y * self.step)
 
         self.collide_rect.center = self.rect.center
 
-        for bullet in self.world.bullets:
-            if bullet.owner == 'player':
-                if self.collide_rect.colliderect(bullet.rect):
-                    self.hp -= 1
-                    if not bullet.invulnerable:
-                        bullet.kill()
-
-        if self.hp <= 0:
-            self.die()
-
     def render(self):
         if self.draw_rect.colliderect(self.window_rect):
             self.window.blit(self.image, self.draw_rect)
@@ -633,10 +688,14 @@ class Crystal(Enemy):
     """The crystal is the goal object of the game, it remains stationary, and
        does not hurt the player, but it has health, and responds to the
        environment, so it is characterized as an enemy"""
+    # Made by load_images() on the main thread, so crystals can be made on
+    # any thread
+    shared_images = None
+
     def __init__(self, window, world, pos):
         super().__init__(window, world)
 
-        self.image = pyg.Surface((80, 80))
+        self.image = Crystal.shared_images['normal']
         self.rect = self.image.get_rect()
         self.rect.center = pos
 
@@ -648,18 +707,22 @@ class Crystal(Enemy):
 
         self.hp = 5
 
-    def update(self, player):
-        for bullet in self.world.bullets:
-            if bullet.owner == 'player':
-                if self.collide_rect.colliderect(bullet.rect):
-                    self.hp -= 1
-                    if not bullet.invulnerable:
-                        bullet.kill()
+    def hurt(self, amount):
+        # The crystal is collected rather than destroyed, see update()
+        self.hp -= amount
 
+    def update(self, player):
         if self.hp <= 0:
-            self.image.fill((0, 200, 0))
+            self.image = Crystal.shared_images['collected']
             player.collect_crystal()
 
+    @classmethod
+    def load_images(cls):
+        if cls.shared_images is None:
+            cls.shared_images = {'normal': pyg.Surface((80, 80)),
+                                 'collected': pyg.Surface((80, 80))}
+            cls.shared_images['collected'].fill((0, 200, 0))
+
 
 class Archer(Enemy):
     """A class to represent an enemy that trys to stay a moderate distance
@@ -704,10 +767,14 @@ class Archer(Enemy):
 
          # If too close to player
         if dist < self.close_range**2 and not player.is_invisible:
-            self.dir = math.atan2((p_pos[1] - self.rect.center[1]),
-                                  (p_pos[0] - self.rect.center[0]))
-            self.vel.x -= math.cos(self.dir) * self.speed
-            self.vel.y -= math.sin(self.dir) * self.speed
+            # Back away along the flow field so the archer isn't pinned
+            # against a wall, or straight away if there is nowhere better
+            self.dir = self.world.flow.get_dir(self.rect.center, away=True)
+            if self.dir is None:
+                self.dir = math.atan2((self.rect.center[1] - p_pos[1]),
+                                      (self.rect.center[0] - p_pos[0]))
+            self.vel.x += math.cos(self.dir) * self.speed
+            self.vel.y += math.sin(self.dir) * self.speed
         elif dist < 3 * self.close_range**2: # Randomly move around
             self.dir = random.triangular(-math.pi, math.pi, self.dir)
             self.vel.x += math.cos(self.dir) * self.speed
@@ -718,8 +785,11 @@ class Archer(Enemy):
             self.vel.x *= .7
             self.vel.y *= .7
 
-        if dist < self.fire_range**2 and not player.is_invisible:
-            self.fire_tick -= 1
+        # Only shoot when the player can see the archer, so arrows don't go
+        # through walls
+        if (dist < self.fire_range**2 and not player.is_invisible and
+            self.world.fov.is_visible(self.rect.center)):
+            self.fire_tick -= self.step
 
         if self.fire_tick <= 0:
             self.fire(p_pos)
@@ -737,8 +807,7 @@ class Archer(Enemy):
                          (p_pos[0] - self.rect.center[0])))
         self.bullet_data['image'] = pyg.transform.rotate(self.b_image, -dir)
 
-        bullet = Bullet(self.window, self.world, self.bullet_data)
-        self.world.bullets.add(bullet)
+        self.world.bullets.spawn(self.bullet_data)
 
 class Charger(Enemy):
     """A class to represent an enemy that has the characteristic to charge
@@ -769,13 +838,17 @@ class Charger(Enemy):
                 (self.rect.centery - player.rect.centery)**2)
 
         if dist < self.seek_range**2 and not player.is_invisible: # Seek out player
-            self.dir = math.atan2((p_pos[1] - self.rect.center[1]),
-                                  (p_pos[0] - self.rect.center[0]))
+            # Follow the flow field around walls, and go straight for the
+            # player once in the same tile
+            self.dir = self.world.flow.get_dir(self.rect.center)
+            if self.dir is None:
+                self.dir = math.atan2((p_pos[1] - self.rect.center[1]),
+                                      (p_pos[0] - self.rect.center[0]))
             self.vel.x += math.cos(self.dir) * self.speed
             self.vel.y += math.sin(self.dir) * self.speed
 
             if self.speed < self.max_speed:
-                self.speed += .07
+                self.speed += .07 * self.step
         elif dist < 2 * self.seek_range**2: # Randomly move around
             self.dir = random.triangular(-math.pi, math.pi, self.dir)
             self.vel.x += math.cos(self.dir) * self.speed
@@ -809,28 +882,364 @@ class Dummy(Enemy):
 
         self.score = 10
 
-    def update(self, player):
-        for wall in self.world.walls:
-            if self.rect.colliderect(wall.rect):
-                if self.vel.x > 0:
-                    self.rect.right = wall.rect.left
-                    self.vel.x *= -1
-                elif self.vel.x < 0:
-                    self.rect.left = wall.rect.right
-                    self.vel.x *= -1
+    def move_x(self, amount):
+        # Bounce off walls instead of stopping
+        amount = int(amount)
+        toi, normal, wall = self.world.sweep(self.rect, amount, 0)
+        if wall is not None:
+            amount = round(amount * toi)
+            self.vel.x *= -1
+        self.rect.x += amount
 
-        for wall in self.world.walls:
-            if self.rect.colliderect(wall.rect):
-                if self.vel.y < 0:
-                    self.rect.top = wall.rect.bottom
-                    self.vel.y *= -1
-                elif self.vel.y > 0:
-                    self.rect.bottom = wall.rect.top
-                    self.vel.y *= -1
+    def move_y(self, amount):
+        amount = int(amount)
+        toi, normal, wall = self.world.sweep(self.rect, 0, amount)
+        if wall is not None:
+            amount = round(amount * toi)
+            self.vel.y *= -1
+        self.rect.y += amount
 
+    def update(self, player):
         super().update()
 
 
+class SpatialHash():
+    def __init__(self, cell_size):
+        """Buckets objects by the grid cells their rect touches, so only the
+        objects near an area need to be looked at. Objects that have been
+        killed are dropped the next time a query finds them."""
+        self.cell_size = cell_size
+        self.cells = {}
+        self.keys = {}
+
+    def get_keys(self, rect):
+        size = self.cell_size
+        return [(x, y)
+                for y in range(rect.top // size, (rect.bottom - 1) // size + 1)
+                for x in range(rect.left // size, (rect.right - 1) // size + 1)]
+
+    def add(self, obj, rect=None):
+        if rect is None:
+            rect = obj.rect
+        keys = self.get_keys(rect)
+        for key in keys:
+            self.cells.setdefault(key, set()).add(obj)
+        self.keys[obj] = keys
+
+    def remove(self, obj):
+        for key in self.keys.pop(obj, []):
+            cell = self.cells[key]
+            cell.discard(obj)
+            if not cell:
+                del self.cells[key]
+
+    def move(self, obj, rect=None):
+        """Update the cells of an object after it has moved. Cheap if it
+        is still in the same cells."""
+        if rect is None:
+            rect = obj.rect
+        if self.keys.get(obj) != self.get_keys(rect):
+            self.remove(obj)
+            self.add(obj, rect)
+
+    def query(self, rect):
+        """Return every live object in the cells that rect touches."""
+        found = set()
+        dead = []
+        for key in self.get_keys(rect):
+            for obj in self.cells.get(key, ()):
+                if obj.alive():
+                    found.add(obj)
+                else:
+                    dead.append(obj)
+
+        for obj in dead:
+            self.remove(obj)
+
+        return found
+
+    def clear(self):
+        self.cells = {}
+        self.keys = {}
+
+
+class AIScheduler():
+    def __init__(self, world, mid_interval=3):
+        """Decides which enemies get to think each tick, so the cost of AI
+        depends on what is near the player instead of the whole level.
+        Enemies in the player's room update every tick, enemies in the rooms
+        next to it update every mid_interval ticks and move that many ticks
+        worth at once, and everything further away sleeps until the player
+        changes rooms."""
+        self.world = world
+        self.mid_interval = mid_interval
+        self.tick = 0
+
+        self.near = []
+        self.mid = []
+
+        self.player_room = None
+        self.enemies = None
+        self.num_enemies = 0
+
+        self.world.add_room_listener(self.on_room_change)
+
+    def on_room_change(self, old_room, new_room):
+        self.sort_enemies(new_room)
+
+    def reset(self):
+        """Forget the tiers when the level changes. The old level's enemies
+        are still alive in its saved groups, so without this they would keep
+        updating until the next sort."""
+        self.near = []
+        self.mid = []
+        self.player_room = None
+        self.enemies = None
+
+    def sort_enemies(self, player_room):
+        """Put every enemy in the level into a tier based on how many rooms
+        away from the player it is."""
+        self.near = []
+        self.mid = []
+
+        for enemy in self.world.enemies:
+            room = self.world.room_at(enemy.rect.center)
+            if room is None or player_room is None:
+                self.near.append(enemy)
+                continue
+
+            dist = max(abs(room.rect.x - player_room.rect.x) // room.rect.width,
+                       abs(room.rect.y - player_room.rect.y) // room.rect.height)
+            if dist == 0:
+                self.near.append(enemy)
+            elif dist == 1:
+                self.mid.append(enemy)
+
+        self.player_room = player_room
+        self.enemies = self.world.enemies
+        self.num_enemies = len(self.world.enemies)
+
+    def update(self, player):
+        self.tick += 1
+
+        # Enemies wander between rooms, so re-sort them once a second as
+        # well as whenever the enemies change. Changing rooms is handled by
+        # on_room_change()
+        if (self.enemies is not self.world.enemies or
+            len(self.world.enemies) != self.num_enemies or
+            self.tick % FPS == 0):
+            self.sort_enemies(self.world.player_room)
+
+        for enemy in self.near:
+            if enemy.alive():
+                enemy.step = 1
+                enemy.update(player)
+
+        # Spread the mid range enemies out over the interval
+        for i, enemy in enumerate(self.mid):
+            if (self.tick + i) % self.mid_interval == 0 and enemy.alive():
+                enemy.step = self.mid_interval
+                enemy.update(player)
+
+
+class FlowField():
+    def __init__(self, world):
+        """A breadth first search out from the player's tile over the
+        walkable tiles of the level. Every tile remembers which neighbouring
+        tile is one step closer to the player, so any number of enemies can
+        chase the player around walls for the cost of a single search. The
+        search only runs again when the player moves to a new tile."""
+        self.world = world
+        self.target = None
+        self.walkable = None
+
+        self.dist = []
+        self.next = []
+
+    def update(self, player):
+        target = self.world.get_tile(player.rect.center)
+        if target == self.target and self.walkable is self.world.walkable:
+            return
+        self.target = target
+        self.walkable = self.world.walkable
+
+        w = self.world.grid_w
+        h = self.world.grid_h
+        walkable = self.walkable
+
+        self.dist = [-1] * (w * h)
+        self.next = [-1] * (w * h)
+        if target is None or not walkable[target]:
+            return
+
+        self.dist[target] = 0
+        self.next[target] = target
+        queue = [target]
+        for cur in queue: # The list grows as it is read, like a queue
+            x = cur % w
+            y = cur // w
+            for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1),
+                           (1, 1), (1, -1), (-1, 1), (-1, -1)):
+                nx = x + dx
+                ny = y + dy
+                if nx < 0 or nx >= w or ny < 0 or ny >= h:
+                    continue
+                n = ny * w + nx
+                if self.dist[n] != -1 or not walkable[n]:
+                    continue
+                # Don't cut across the corner of a wall
+                if dx and dy and not (walkable[y * w + nx] and walkable[ny * w + x]):
+                    continue
+
+                self.dist[n] = self.dist[cur] + 1
+                self.next[n] = cur
+                queue.append(n)
+
+    def get_dir(self, pos, away=False):
+        """Return the angle to move in from pos to get closer to the player,
+        or further away if away is True. Returns None when there is no
+        useful direction, e.g. already in the player's tile."""
+        cell = self.world.get_tile(pos)
+        if cell is None or not self.dist or self.dist[cell] == -1:
+            return None
+
+        if not away:
+            step = self.next[cell]
+            if step == cell:
+                return None
+        else:
+            w = self.world.grid_w
+            x = cell % w
+            y = cell // w
+            step = cell
+            for nx in range(max(x - 1, 0), min(x + 2, w)):
+                for ny in range(max(y - 1, 0), min(y + 2, self.world.grid_h)):
+                    n = ny * w + nx
+                    if self.dist[n] > self.dist[step]:
+                        step = n
+            if step == cell:
+                return None
+
+        x, y = self.world.get_tile_center(step)
+        return math.atan2(y - pos[1], x - pos[0])
+
+
+class FieldOfView():
+    # Multipliers that map the first octant onto each of the eight octants
+    octants = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+    def __init__(self, world, radius=16):
+        """Which tiles the player can see, worked out with recursive
+        shadowcasting over the level's tile grid. It is only recomputed when
+        the player moves into a new tile. Tiles out of sight are darkened
+        when rendering, and archers use it to avoid shooting through
+        walls."""
+        self.world = world
+        self.radius = radius
+        self.origin = None
+        self.opaque = None
+
+        self.visible = bytearray()
+        self.dark_rects = []
+
+        self.shade = (110, 110, 110)
+
+    def update(self, player):
+        origin = self.world.get_tile(player.rect.center)
+        if origin == self.origin and self.opaque is self.world.opaque:
+            return
+        self.origin = origin
+        self.opaque = self.world.opaque
+
+        self.visible = bytearray(self.world.grid_w * self.world.grid_h)
+        if origin is not None:
+            ox = origin % self.world.grid_w
+            oy = origin // self.world.grid_w
+            self.visible[origin] = 1
+            for octant in self.octants:
+                self.cast_light(ox, oy, 1, 1.0, 0.0, *octant)
+
+        self.build_dark_rects()
+
+    def cast_light(self, ox, oy, row, start, end, xx, xy, yx, yy):
+        """Light up one octant, starting at row, between the slopes start
+        and end. Recurses past each wall it finds to scan the gap beside it."""
+        if start < end:
+            return
+
+        w = self.world.grid_w
+        h = self.world.grid_h
+        opaque = self.opaque
+        visible = self.visible
+        radius_sq = self.radius**2
+        new_start = start
+
+        for j in range(row, self.radius + 1):
+            dx = -j - 1
+            dy = -j
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                l_slope = (dx - .5) / (dy + .5)
+                r_slope = (dx + .5) / (dy - .5)
+                if start < r_slope:
+                    continue
+                elif end > l_slope:
+                    break
+
+                x = ox + dx * xx + dy * xy
+                y = oy + dx * yx + dy * yy
+                in_bounds = 0 <= x < w and 0 <= y < h
+                if in_bounds and dx*dx + dy*dy < radius_sq:
+                    visible[y * w + x] = 1
+
+                is_opaque = not in_bounds or opaque[y * w + x]
+                if blocked:
+                    if is_opaque:
+                        new_start = r_slope
+                    else:
+                        blocked = False
+                        start = new_start
+                elif is_opaque and j < self.radius:
+                    blocked = True
+                    self.cast_light(ox, oy, j + 1, start, l_slope, xx, xy, yx, yy)
+                    new_start = r_slope
+            if blocked:
+                break
+
+    def build_dark_rects(self):
+        """Join the tiles that can't be seen into one rect per run along each
+        row, so darkening them takes a few fills instead of one per tile."""
+        w = self.world.grid_w
+        size = self.world.tile_size
+        self.dark_rects = []
+        for ty in range(self.world.grid_h):
+            row = self.visible[ty * w:(ty + 1) * w]
+            tx = 0
+            while tx < w:
+                if row[tx]:
+                    tx += 1
+                    continue
+                start = tx
+                while tx < w and not row[tx]:
+                    tx += 1
+                self.dark_rects.append(pyg.rect.Rect(start * size, ty * size,
+                                                     (tx - start) * size, size))
+
+    def is_visible(self, pos):
+        tile = self.world.get_tile(pos)
+        return tile is not None and tile < len(self.visible) and bool(self.visible[tile])
+
+    def render(self, window, offset):
+        """Darken every tile that the player can't see."""
+        window_rect = window.get_rect()
+        for rect in self.dark_rects:
+            rect = rect.move(offset)
+            if rect.colliderect(window_rect):
+                window.fill(self.shade, rect, special_flags=pyg.BLEND_MULT)
+
+
 class Sensor(pyg.sprite.Sprite):
     def __init__(self, window, world, rect, type, detail, num_uses=-1):
         super().__init__()
@@ -845,28 +1254,71 @@ class Sensor(pyg.sprite.Sprite):
 
         self.num_uses = num_uses
 
-    def trigger(self):
-        self.world.trigger(self.type, self.detail, self.rect)
-        self.num_uses -= 1
-        if self.num_uses == 0:
-            self.kill()
+    def trigger(self, event, entity):
+        """Called by the SensorSystem when entity enters, stays in, or exits
+        the sensor. A use is only spent on entering."""
+        if event == 'enter':
+            self.color = (0, 250, 0)
+        elif event == 'exit':
+            self.color = (0, 0, 0)
 
-    def update(self, player):
-        if self.type == 'touch':
-            if self.draw_rect.colliderect(player.draw_rect):
-                self.triggered = True
-                self.color = (0, 250, 0)
-            else:
-                self.triggered = False
-                self.color = (0, 0, 0)
+        self.world.trigger(self.type, self.detail, self.rect, event, entity)
 
-        if self.triggered:
-            self.trigger()
+        if event == 'enter':
+            self.num_uses -= 1
+            if self.num_uses == 0:
+                self.kill()
 
     def render(self):
         pyg.draw.rect(self.window, self.color, self.draw_rect, 10)
 
 
+class SensorSystem():
+    def __init__(self, world):
+        """Keeps the level's sensors in a spatial index, and works out when
+        entities enter, stay in and exit them. Only entities that moved since
+        the last tick are tested, and only against sensors in the cells they
+        touch. Entities that stand still just get a 'stay' event for the
+        sensors they were already in."""
+        self.world = world
+        self.index = SpatialHash(150)
+
+        self.touching = {}
+        self.last_rects = {}
+
+    def build(self):
+        """Index every sensor on the current level."""
+        self.index.clear()
+        self.touching = {}
+        self.last_rects = {}
+        for sensor in self.world.sensors:
+            self.index.add(sensor)
+
+    def add(self, sensor):
+        self.index.add(sensor)
+
+    def update(self, entities):
+        for entity in entities:
+            old = self.touching.get(entity, set())
+            old = {sensor for sensor in old if sensor.alive()}
+
+            if self.last_rects.get(entity) == entity.rect:
+                new = old
+            else:
+                self.last_rects[entity] = entity.rect.copy()
+                new = {sensor for sensor in self.index.query(entity.rect)
+                       if sensor.rect.colliderect(entity.rect)}
+
+            for sensor in old - new:
+                sensor.trigger('exit', entity)
+            for sensor in old & new:
+                sensor.trigger('stay', entity)
+            for sensor in new - old:
+                sensor.trigger('enter', entity)
+
+            self.touching[entity] = new
+
+
 class HUD():
     """
         XXX        XXX
@@ -909,6 +1361,8 @@ class HUD():
         self.fps_rect = self.fps_image.get_rect()
         self.fps_rect.topright = self.level_rect.move(0, 10).bottomright
 
+        self.minimap = Minimap(window, self.player.world, (10, HEIGHT - 10))
+
         self.update('hp')
 
     def update(self, *args):
@@ -946,24 +1400,115 @@ class HUD():
         self.window.blit(self.pos_image, self.pos_rect)
         self.window.blit(self.level_image, self.level_rect)
         self.window.blit(self.fps_image, self.fps_rect)
+        self.minimap.render(self.player)
+
+
+class Minimap():
+    def __init__(self, window, world, bottomleft, tile_px=4):
+        """A small map of the level drawn in the corner of the screen. The
+        walls and fog are painted onto a cached surface once per level, and
+        only the room the player walks into is repainted after that. Each
+        frame costs one blit plus a dot for the player and each visible
+        enemy."""
+        self.window = window
+        self.world = world
+        self.bottomleft = bottomleft
+        self.tile_px = tile_px
+
+        self.floor_col = (60, 60, 60)
+        self.wall_col = (140, 140, 140)
+        self.fog_col = (20, 20, 20)
+        self.player_col = (0, 150, 250)
+        self.enemy_col = (200, 0, 0)
+
+        self.walkable = None
+
+        self.world.add_room_listener(self.on_room_change)
+
+    def build(self):
+        """Paint the whole map for the current level."""
+        self.walkable = self.world.walkable
+        self.image = pyg.Surface((self.world.grid_w * self.tile_px,
+                                  self.world.grid_h * self.tile_px)).convert()
+        self.rect = self.image.get_rect()
+        self.rect.bottomleft = self.bottomleft
+
+        for room in self.world.rooms:
+            self.paint_room(room)
+
+    def paint_room(self, room):
+        """Paint the tiles of one room, or cover it if it is still fogged."""
+        size = self.world.tile_size
+        area = pyg.rect.Rect(room.rect.x // size * self.tile_px,
+                             room.rect.y // size * self.tile_px,
+                             room.rect.width // size * self.tile_px,
+                             room.rect.height // size * self.tile_px)
+
+        if any(fog.alive() for fog in room.fogs):
+            self.image.fill(self.fog_col, area)
+            return
+
+        tile_rect = pyg.rect.Rect(0, 0, self.tile_px, self.tile_px)
+        for ty in range(room.rect.top // size, room.rect.bottom // size):
+            for tx in range(room.rect.left // size, room.rect.right // size):
+                tile_rect.topleft = (tx * self.tile_px, ty * self.tile_px)
+                if self.walkable[ty * self.world.grid_w + tx]:
+                    self.image.fill(self.floor_col, tile_rect)
+                else:
+                    self.image.fill(self.wall_col, tile_rect)
+
+    def on_room_change(self, old_room, new_room):
+        if self.walkable is not self.world.walkable:
+            self.build()
+        elif new_room is not None:
+            self.paint_room(new_room)
+
+    def to_map(self, pos):
+        """Convert a world position to a position on the screen."""
+        return (self.rect.x + pos[0] * self.tile_px // self.world.tile_size,
+                self.rect.y + pos[1] * self.tile_px // self.world.tile_size)
+
+    def render(self, player):
+        if self.walkable is not self.world.walkable:
+            self.build()
+
+        self.window.blit(self.image, self.rect)
+
+        for enemy in self.world.enemies:
+            room = self.world.room_at(enemy.rect.center)
+            if room is not None and not any(fog.alive() for fog in room.fogs):
+                self.window.fill(self.enemy_col, (self.to_map(enemy.rect.center), (3, 3)))
+
+        self.window.fill(self.player_col, (self.to_map(player.rect.center), (4, 4)))
 
 
 class PauseMenu():
     def __init__(self, window):
+        """The pause menu is drawn over a frozen copy of the last frame, so
+        the world isn't rendered again while paused. Only the buttons that
+        change hover state are redrawn, and update() returns the areas that
+        changed so the caller can update just those parts of the display."""
         self.window = window
 
         self.grayout = pyg.Surface((WIDTH, HEIGHT)).convert_alpha()
         self.grayout.fill((0, 0, 0, 100))
 
         self.button_text = ['CONTINUE', 'OPTIONS', 'EXIT']
+        self.button_images = []
         self.buttons = self.make_buttons()
         self.arrange_buttons()
 
+        self.frame = None
+        self.image = None
+
     def make_buttons(self):
         buttons = []
 
         for text in self.button_text:
             image = fonts['londrina36'].render(f'| {text} |', True, (0, 150, 250))
+            hover_image = fonts['londrina40'].render(f'| {text} |', True, (0, 150, 250))
+            self.button_images.append((image, hover_image))
+
             rect = image.get_rect()
             buttons.append([image, rect, text])
 
@@ -975,21 +1520,119 @@ class PauseMenu():
             button[1].centerx = WIDTH//2
             button[1].centery = HEIGHT//2 + 120*i - 60*len(self.buttons) + 60
 
+    def freeze(self):
+        """Take the current contents of the window as the background of the
+        menu and draw the whole menu once."""
+        self.frame = self.window.copy()
+        self.frame.blit(self.grayout, (0, 0))
+
+        for i, button in enumerate(self.buttons):
+            button[0] = self.button_images[i][0]
+            button[1] = button[0].get_rect()
+        self.arrange_buttons()
+
+        self.image = self.frame.copy()
+        for b in self.buttons:
+            self.image.blit(b[0], b[1])
+
+        self.window.blit(self.image, (0, 0))
+
+    def unfreeze(self):
+        self.frame = None
+        self.image = None
+
     def update(self):
-        m_pos = pyg.mouse.get_pos()
+        """Swap the image of any button whose hover state changed, and return
+        a list of the rects that need to be redrawn."""
+        dirty = []
+        m_pos = get_mouse_pos()
         for i, button in enumerate(self.buttons):
             if button[1].collidepoint(m_pos):
-                button[0] = fonts['londrina40'].render(f'| {self.button_text[i]} |', True, (0, 150, 250))
+                image = self.button_images[i][1]
             else:
-                button[0] = fonts['londrina36'].render(f'| {self.button_text[i]} |', True, (0, 150, 250))
-            button[1] = button[0].get_rect()
+                image = self.button_images[i][0]
+            if image is button[0]:
+                continue
+
+            # Clear the old button before drawing the new one over it
+            old_rect = button[1]
+            button[0] = image
+            button[1] = image.get_rect()
+            self.arrange_buttons()
+
+            area = old_rect.union(button[1])
+            self.image.blit(self.frame, area, area)
+            self.image.blit(button[0], button[1])
+            dirty.append(area)
+
+        return dirty
+
+    def render(self, rects=None):
+        """Draw the menu to the window, or only the given parts of it."""
+        if rects is None:
+            self.window.blit(self.image, (0, 0))
+        else:
+            for rect in rects:
+                self.window.blit(self.image, rect, rect)
 
-        self.arrange_buttons()
 
-    def render(self):
-        self.window.blit(self.grayout, (0, 0))
-        for b in self.buttons:
-            self.window.blit(b[0], b[1])
+class LoadingScreen():
+    def __init__(self, window, workers=4):
+        """Runs slow work on worker threads while showing a progress bar, so
+        the game never looks frozen. Work on a worker must not make or
+        convert surfaces, that has to happen on this thread after run()
+        returns. Assets a task uses should be loaded before it starts."""
+        self.window = window
+        self.workers = workers
+
+        self.bar_rect = pyg.rect.Rect(0, 0, WIDTH // 3, 16)
+        self.bar_rect.center = (WIDTH // 2, HEIGHT // 2 + 40)
+
+    def run(self, title, tasks):
+        """Run every (label, function) in tasks, which must not depend on
+        each other, and return their results in order. If they are all
+        quick the screen is never shown."""
+        clock = pyg.time.Clock()
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(func) for label, func in tasks]
+            pending = set(futures)
+            shown = False
+
+            while True:
+                done, pending = wait(pending, timeout=1 / FPS, return_when=FIRST_COMPLETED)
+                if not pending:
+                    break
+
+                for event in pyg.event.get():
+                    if event.type == pyg.QUIT:
+                        terminate()
+
+                labels = [label for (label, func), f in zip(tasks, futures) if not f.done()]
+                self.render(title, labels[0], 1 - len(pending) / len(futures))
+                screen.present()
+                shown = True
+                clock.tick(FPS)
+
+            if shown:
+                self.render(title, '', 1)
+                screen.present()
+
+        # Raises any exception from a task here, instead of losing it
+        return [f.result() for f in futures]
+
+    def render(self, title, label, progress):
+        self.window.fill((20, 20, 20))
+
+        title_image = fonts['londrina40'].render(title, True, (0, 150, 250))
+        self.window.blit(title_image, title_image.get_rect(midbottom=(WIDTH // 2, HEIGHT // 2)))
+
+        pyg.draw.rect(self.window, (60, 60, 60), self.bar_rect)
+        bar = self.bar_rect.copy()
+        bar.width = round(bar.width * progress)
+        pyg.draw.rect(self.window, (0, 150, 250), bar)
+
+        label_image = fonts['apache30'].render(label, True, (150, 150, 150))
+        self.window.blit(label_image, label_image.get_rect(midtop=(WIDTH // 2, self.bar_rect.bottom + 10)))
 
 
 class Camera():
@@ -1012,7 +1655,9 @@ class Camera():
 
     def apply_lens(self, player, world, world_decor):
         player.draw_rect = player.rect.move(self.rect.topleft)
-        world_decor.bg_draw_rect = world_decor.bg_rect.move(self.rect.topleft)
+        # A game without a window has no background
+        if world_decor is not None:
+            world_decor.bg_draw_rect = world_decor.bg_rect.move(self.rect.topleft)
 
         everything = (world.walls.sprites() +
                       world.statics.sprites() +
@@ -1037,6 +1682,444 @@ class Camera():
         self.rect = pyg.rect.Rect(-top, -left, width, height)
 
 
+class LayerRenderer():
+    def __init__(self, window):
+        """Draws a whole layer of sprites with one Surface.blits() call. The
+        image and position of every sprite on screen is gathered first,
+        instead of calling render() on each sprite."""
+        self.window = window
+        self.window_rect = window.get_rect()
+
+    def render(self, sprites):
+        window_rect = self.window_rect
+        self.window.blits([(s.image, s.draw_rect) for s in sprites
+                           if s.draw_rect.colliderect(window_rect)], doreturn=False)
+
+    def render_sorted(self, sprites, player):
+        """Draw sprites in the order given. They are batched like a normal
+        layer, except for the player who draws their own weapon."""
+        window_rect = self.window_rect
+        batch = []
+        for s in sprites:
+            if s is player:
+                self.window.blits(batch, doreturn=False)
+                batch = []
+                player.render()
+            elif s.draw_rect.colliderect(window_rect):
+                batch.append((s.image, s.draw_rect))
+        self.window.blits(batch, doreturn=False)
+
+    def render_pickups(self, pickups):
+        """Pickups on the ground have a shadow under them, so draw all the
+        shadows before any of the pickups."""
+        window_rect = self.window_rect
+        on_screen = [p for p in pickups if p.draw_rect.colliderect(window_rect)]
+        self.window.blits([(p.shadow, p.draw_rect.move(0, 15)) for p in on_screen if p.on_ground] +
+                          [(p.image, p.draw_rect) for p in on_screen], doreturn=False)
+
+
+class DepthSorter():
+    def __init__(self):
+        """Keeps the sprites that stand up in the world and are on screen
+        ordered by the bottom of their rect, then by x, so whatever is lower
+        on the screen is drawn in front. Most sprites only move a little
+        each frame, so last frame's order is nearly right already and an
+        insertion sort fixes it in close to O(n) instead of sorting
+        everything from scratch."""
+        self.sprites = []
+
+    def update(self, groups, area):
+        """Bring the list up to date with the sprites in groups that are
+        drawn inside area, then put it back in order. New sprites are added
+        in group order, so sprites at the same depth keep the same order
+        every run."""
+        # A dict keeps the order things were added in, unlike a set
+        current = {}
+        for group in groups:
+            for sprite in group:
+                if sprite.draw_rect.colliderect(area):
+                    current[sprite] = None
+
+        kept = [sprite for sprite in self.sprites if sprite in current]
+        for sprite in kept:
+            del current[sprite]
+        sprites = kept + list(current)
+
+        for i in range(1, len(sprites)):
+            sprite = sprites[i]
+            key = (sprite.rect.bottom, sprite.rect.x)
+            j = i - 1
+            while j >= 0 and (sprites[j].rect.bottom, sprites[j].rect.x) > key:
+                sprites[j + 1] = sprites[j]
+                j -= 1
+            sprites[j + 1] = sprite
+
+        self.sprites = sprites
+
+
+class ParticleSystem():
+    # color, size, (min, max) speed, (min, max) life in ticks, drag
+    styles = {'spark': ((255, 220, 120), 3, (3, 8), (4, 9), .75),
+              'trail': ((150, 110, 70), 2, (0, 1), (5, 8), .9),
+              'death': ((200, 40, 40), 4, (2, 9), (10, 20), .85),
+              'sparkle': ((120, 220, 255), 3, (1, 5), (10, 18), .9)}
+
+    def __init__(self, window, capacity=1024):
+        """Small squares that fly out from things and fade, e.g. sparks when
+        a bullet hits a wall. Particles are stored in NumPy columns with the
+        live ones packed at the front, oldest first, so there is never more
+        than capacity of them. When it is full, new particles replace the
+        oldest ones. All of them are moved with a few array operations and
+        drawn with one blits() call."""
+        self.window = window
+        self.window_rect = window.get_rect()
+        self.capacity = capacity
+
+        self.x = np.zeros(capacity, np.float32)
+        self.y = np.zeros(capacity, np.float32)
+        self.vx = np.zeros(capacity, np.float32)
+        self.vy = np.zeros(capacity, np.float32)
+        self.drag = np.zeros(capacity, np.float32)
+        self.life = np.zeros(capacity, np.int16)
+        self.style = np.zeros(capacity, np.uint8)
+        self.columns = [self.x, self.y, self.vx, self.vy, self.drag, self.life, self.style]
+
+        self.style_names = list(self.styles)
+        self.images = []
+        for name in self.style_names:
+            color, size = self.styles[name][:2]
+            image = pyg.Surface((size, size)).convert()
+            image.fill(color)
+            self.images.append(image)
+
+        self.count = 0
+
+    def emit(self, pos, style, num, angle=None, spread=math.pi):
+        """Spawn num particles of a style at pos. They fly out in every
+        direction, or within spread of angle if it is given."""
+        color, size, speed, life, drag = self.styles[style]
+        num = min(num, self.capacity)
+        # Use the random module so seeded runs stay the same
+        vx, vy, lives = [], [], []
+        for i in range(num):
+            if angle is None:
+                dir = random.uniform(-math.pi, math.pi)
+            else:
+                dir = angle + random.uniform(-spread, spread)
+            v = random.uniform(*speed)
+            vx.append(math.cos(dir) * v)
+            vy.append(math.sin(dir) * v)
+            lives.append(random.randint(*life))
+
+        # Make room by dropping the oldest particles from the front
+        extra = self.count + num - self.capacity
+        if extra > 0:
+            for column in self.columns:
+                column[:self.count - extra] = column[extra:self.count]
+            self.count -= extra
+
+        new = slice(self.count, self.count + num)
+        self.x[new] = pos[0]
+        self.y[new] = pos[1]
+        self.vx[new] = vx
+        self.vy[new] = vy
+        self.drag[new] = drag
+        self.life[new] = lives
+        self.style[new] = self.style_names.index(style)
+        self.count += num
+
+    def clear(self):
+        self.count = 0
+
+    def update(self):
+        n = self.count
+        if not n:
+            return
+        x, y, vx, vy, drag, life = (column[:n] for column in self.columns[:6])
+        x += vx
+        y += vy
+        vx *= drag
+        vy *= drag
+        life -= 1
+
+        # Pack the ones still alive to the front, keeping their order
+        alive = life > 0
+        if not alive.all():
+            for column in self.columns:
+                live = column[:n][alive]
+                column[:len(live)] = live
+            self.count = int(alive.sum())
+
+    def render(self, offset):
+        n = self.count
+        if not n:
+            return
+        w, h = self.window_rect.size
+        px = self.x[:n].astype(np.int32) + offset[0]
+        py = self.y[:n].astype(np.int32) + offset[1]
+        visible = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        images = self.images
+        blits = [(images[style], (x, y)) for style, x, y in
+                 zip(self.style[:n][visible].tolist(), px[visible].tolist(), py[visible].tolist())]
+        self.window.blits(blits, doreturn=False)
+
+
+class SoundManager():
+    def __init__(self, sounds, settings, num_channels=16):
+        """Plays sounds on a fixed set of mixer channels. Each sound has a
+        setting of (max_voices, cooldown, priority): how many copies of it
+        can play at once, how many milliseconds must pass before it plays
+        again, and how important it is. If a sound is already at its limit,
+        its oldest copy is cut off. If every channel is busy, the oldest
+        sound with the lowest priority that isn't more important than the
+        new one is cut off instead, and if there is none, the new sound
+        isn't played."""
+        self.sounds = sounds
+        self.settings = settings
+        self.default_setting = (4, 0, 1)
+
+        self.enabled = pyg.mixer.get_init() is not None
+        if not self.enabled:
+            return
+
+        pyg.mixer.set_num_channels(num_channels)
+        self.channels = [pyg.mixer.Channel(i) for i in range(num_channels)]
+        # (name, priority, start time) of what each channel last played
+        self.voices = [None] * num_channels
+        self.last_played = {}
+
+    def play(self, name):
+        """Play a sound by name, returning the channel it plays on, or None
+        if it was skipped."""
+        if not self.enabled:
+            return None
+
+        max_voices, cooldown, priority = self.settings.get(name, self.default_setting)
+        now = pyg.time.get_ticks()
+        if name in self.last_played and now - self.last_played[name] < cooldown:
+            return None
+
+        busy = [i for i, channel in enumerate(self.channels) if channel.get_busy()]
+        # Channels started outside the manager have no voice to compare against
+        known = [i for i in busy if self.voices[i] is not None]
+        same = [i for i in known if self.voices[i][0] == name]
+
+        if len(same) >= max_voices:
+            index = min(same, key=lambda i: self.voices[i][2])
+        elif len(busy) < len(self.channels):
+            index = next(i for i, channel in enumerate(self.channels) if i not in busy)
+        else:
+            stealable = [i for i in known if self.voices[i][1] <= priority]
+            if not stealable:
+                return None
+            index = min(stealable, key=lambda i: (self.voices[i][1], self.voices[i][2]))
+
+        channel = self.channels[index]
+        channel.play(self.sounds[name])
+        self.voices[index] = (name, priority, now)
+        self.last_played[name] = now
+
+        return channel
+
+
+class Screen():
+    def __init__(self, display, size=None, smooth=False):
+        """The game is drawn to an off-screen surface of a fixed size, which
+        is then scaled up to fill the display. That way the cost of drawing
+        doesn't grow with the size of the monitor. When possible the surface
+        is scaled by a whole number so pixels stay sharp, otherwise it is
+        smoothly scaled to fit. If size is the size of the display, the game
+        draws straight to the display instead."""
+        self.display = display
+        self.display_rect = display.get_rect()
+
+        if size is None or tuple(size) == self.display_rect.size:
+            self.surface = display
+            self.rect = self.display_rect
+            self.is_scaled = False
+            return
+
+        self.surface = pyg.Surface(size).convert()
+        self.rect = self.surface.get_rect()
+        self.is_scaled = True
+
+        self.scale = min(self.display_rect.width // self.rect.width,
+                         self.display_rect.height // self.rect.height)
+        self.smooth = smooth or self.scale < 1
+        if self.smooth:
+            fit = min(self.display_rect.width / self.rect.width,
+                      self.display_rect.height / self.rect.height)
+            dest_size = (int(self.rect.width * fit), int(self.rect.height * fit))
+        else:
+            dest_size = (self.rect.width * self.scale, self.rect.height * self.scale)
+
+        # Scale straight into the middle of the display, with black bars
+        # around it if the shapes don't match
+        self.dest_rect = pyg.rect.Rect((0, 0), dest_size)
+        self.dest_rect.center = self.display_rect.center
+        self.dest = self.display.subsurface(self.dest_rect)
+        self.display.fill((0, 0, 0))
+        pyg.display.flip()
+
+    def present(self, rects=None):
+        """Show the frame, or only the given parts of it."""
+        if not self.is_scaled:
+            if rects is None:
+                pyg.display.flip()
+            else:
+                pyg.display.update(rects)
+            return
+
+        if self.smooth:
+            pyg.transform.smoothscale(self.surface, self.dest_rect.size, self.dest)
+        elif rects is None:
+            pyg.transform.scale(self.surface, self.dest_rect.size, self.dest)
+        else:
+            for rect in rects:
+                rect = rect.clip(self.rect)
+                if rect.width and rect.height:
+                    area = self.to_display_rect(rect).move(-self.dest_rect.x, -self.dest_rect.y)
+                    pyg.transform.scale(self.surface.subsurface(rect), area.size,
+                                        self.dest.subsurface(area))
+
+        if rects is None:
+            pyg.display.flip()
+        else:
+            pyg.display.update([self.to_display_rect(rect) for rect in rects])
+
+    def to_display_rect(self, rect):
+        """Convert a rect on the game surface to one on the display."""
+        if not self.is_scaled:
+            return pyg.rect.Rect(rect)
+        sx = self.dest_rect.width / self.rect.width
+        sy = self.dest_rect.height / self.rect.height
+        left = self.dest_rect.x + int(rect.left * sx)
+        top = self.dest_rect.y + int(rect.top * sy)
+        right = self.dest_rect.x + math.ceil(rect.right * sx)
+        bottom = self.dest_rect.y + math.ceil(rect.bottom * sy)
+        return pyg.rect.Rect(left, top, right - left, bottom - top)
+
+    def to_logical(self, pos):
+        """Convert a position on the display, e.g. the mouse, to a position
+        on the game surface."""
+        if not self.is_scaled:
+            return pos
+        x = (pos[0] - self.dest_rect.x) * self.rect.width // self.dest_rect.width
+        y = (pos[1] - self.dest_rect.y) * self.rect.height // self.dest_rect.height
+        return (min(max(x, 0), self.rect.width - 1), min(max(y, 0), self.rect.height - 1))
+
+
+class Input():
+    # The keys that are held down to play. Recordings store a bit for each,
+    # so only ever add to the end
+    held_keys = [pyg.K_LEFT, pyg.K_a, pyg.K_RIGHT, pyg.K_d,
+                 pyg.K_UP, pyg.K_w, pyg.K_DOWN, pyg.K_s]
+
+    def __init__(self, screen):
+        """Everything the game reads from the player in a tick: the events,
+        which keys are held and where the mouse is. It is read once at the
+        start of the tick by poll(), and the game only looks at it through
+        here, so a session can be recorded and played back."""
+        self.screen = screen
+        self.events = []
+        self.keys = frozenset()
+        self.mouse_pos = (0, 0)
+
+    def poll(self):
+        """Read the input for the next tick."""
+        self.events = []
+        for event in pyg.event.get():
+            if event.type in [pyg.QUIT, pyg.KEYDOWN]:
+                self.events.append(event)
+            elif event.type == pyg.MOUSEBUTTONDOWN:
+                # Clicks are on the game surface, like the mouse
+                self.events.append(pyg.event.Event(pyg.MOUSEBUTTONDOWN, button=event.button,
+                                                   pos=self.screen.to_logical(event.pos)))
+
+        pressed = pyg.key.get_pressed()
+        self.keys = frozenset(key for key in self.held_keys if pressed[key])
+        self.mouse_pos = self.screen.to_logical(pyg.mouse.get_pos())
+
+
+class InputRecorder(Input):
+    def __init__(self, screen, path, seed):
+        """Reads input like Input, and writes every tick of it to path."""
+        super().__init__(screen)
+        self.writer = replay.Writer(path, seed, screen.rect.size, FPS)
+
+    def poll(self):
+        super().poll()
+
+        keys = 0
+        for i, key in enumerate(self.held_keys):
+            if key in self.keys:
+                keys |= 1 << i
+
+        events = []
+        for event in self.events:
+            if event.type == pyg.QUIT:
+                events.append((replay.QUIT, ()))
+            elif event.type == pyg.KEYDOWN:
+                events.append((replay.KEYDOWN, (event.key,)))
+            elif event.type == pyg.MOUSEBUTTONDOWN:
+                events.append((replay.MOUSEBUTTONDOWN, (event.button, *event.pos)))
+
+        self.writer.write_tick(keys, self.mouse_pos, events)
+
+
+class InputReplay(Input):
+    def __init__(self, screen, reader):
+        """Plays back the input of a recording one tick at a time, ignoring
+        the real keyboard and mouse. When the recording runs out, prints
+        how long the ticks took and quits."""
+        super().__init__(screen)
+        self.ticks = reader.ticks()
+
+        self.num_ticks = 0
+        self.start = None
+        self.last = None
+        self.slowest = 0
+
+    def poll(self):
+        # Keep the window responding, and let it be closed
+        for event in pyg.event.get():
+            if event.type == pyg.QUIT:
+                terminate()
+
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        else:
+            self.slowest = max(self.slowest, now - self.last)
+        self.last = now
+
+        try:
+            keys, mouse, events = next(self.ticks)
+        except StopIteration:
+            self.report()
+            terminate()
+
+        self.keys = frozenset(key for i, key in enumerate(self.held_keys) if keys >> i & 1)
+        self.mouse_pos = mouse
+
+        self.events = []
+        for type, args in events:
+            if type == replay.QUIT:
+                self.events.append(pyg.event.Event(pyg.QUIT))
+            elif type == replay.KEYDOWN:
+                self.events.append(pyg.event.Event(pyg.KEYDOWN, key=args[0]))
+            elif type == replay.MOUSEBUTTONDOWN:
+                self.events.append(pyg.event.Event(pyg.MOUSEBUTTONDOWN, button=args[0], pos=args[1:]))
+        self.num_ticks += 1
+
+    def report(self):
+        seconds = self.last - self.start
+        print(f'Replayed {self.num_ticks} ticks in {seconds:.2f} s')
+        if self.num_ticks > 1:
+            print(f'  mean tick  {seconds / (self.num_ticks - 1) * 1000:8.2f} ms')
+            print(f'  worst tick {self.slowest * 1000:8.2f} ms')
+
+
 class World():
     """
         XXX         XXX
@@ -1057,23 +2140,152 @@ class World():
         self.sensors = pyg.sprite.Group()
         self.pickups = pyg.sprite.Group()
         self.enemies = pyg.sprite.Group()
-        self.bullets = pyg.sprite.Group()
+        self.bullets = BulletPool(window, self)
         self.fogs = pyg.sprite.Group()
 
+        self.tile_size = 75
+        self.grid_w = 0
+        self.grid_h = 0
+        self.walkable = bytearray()
+        self.opaque = bytearray()
+        self.free_tiles = []
+        self.room_free_tiles = {}
+
+        self.pickup_index = SpatialHash(150)
+        self.magnet_range = 100
+        # Pickups that are being pulled, or still slowing down from it
+        self.moving_pickups = set()
+
+        # What moving things run into: the collide_rects of walls and
+        # statics, and for bullets the whole rect of each wall
+        self.solid_index = SpatialHash(150)
+        self.wall_index = SpatialHash(150)
+
+        self.room_size = (750, 600)
+        self.player_room = None
+        self.room_listeners = [self.reveal_room]
+
+        self.sensor_system = SensorSystem(self)
+        self.particles = ParticleSystem(window)
+
+        self.ai = AIScheduler(self)
+        self.flow = FlowField(self)
+        self.fov = FieldOfView(self)
+
         self.saved_levels = {}
 
+        # Groups of walls made by generate() or restore() that still need
+        # their covers drawn by build_images()
+        self.untextured = []
+
+        RoomFog.load_image()
+        Crystal.load_images()
+
     def save_level(self, cur_level):
-        self.saved_levels[cur_level] = {'rooms': self.rooms[:],
-                                        'walls': self.walls.copy(),
-                                        'statics': self.statics.copy(),
-                                        'sensors': self.sensors.copy(),
-                                        'pickups': self.pickups.copy(),
-                                        'enemies': self.enemies.copy(),
-                                        'bullets': self.bullets.copy(),
-                                        'fogs': self.fogs.copy(),
-                                        'up_ladder': self.up_ladder,
-                                        'down_ladder': self.down_ladder,
-                                        'crystal': self.crystal}
+        self.saved_levels[cur_level] = self.level_state()
+
+    def level_state(self):
+        return {'rooms': self.rooms[:],
+                'walls': self.walls.copy(),
+                'statics': self.statics.copy(),
+                'sensors': self.sensors.copy(),
+                'pickups': self.pickups.copy(),
+                'enemies': self.enemies.copy(),
+                'fogs': self.fogs.copy(),
+                'up_ladder': self.up_ladder,
+                'down_ladder': self.down_ladder,
+                'crystal': self.crystal}
+
+    def snapshot(self, cur_level):
+        """Describe every visited level with plain numbers and names, for
+        savegame to write to disk. Nothing in it refers to a live sprite, so
+        it can be handed to another thread."""
+        levels = dict(self.saved_levels)
+        levels[cur_level] = self.level_state()
+
+        snapshot = {}
+        for level, state in levels.items():
+            snapshot[level] = {
+                'size': self.rect.size,
+                'walls': [(w.type, w.rect.x, w.rect.y) for w in state['walls']],
+                'statics': [(f'ladder_{s.dir}' if isinstance(s, Ladder) else 'fountain', *s.rect.center)
+                            for s in state['statics']],
+                'pickups': [(p.type, *p.rect.topleft) for p in state['pickups']],
+                'enemies': [(type(e).__name__.lower(), *e.rect.center, e.hp, e.vel.x, e.vel.y)
+                            for e in state['enemies']],
+                'fog': [any(fog.alive() for fog in room.fogs) for room in state['rooms']]}
+            # Sensors aren't saved, since levels don't create any yet
+
+        return snapshot
+
+    def restore(self, levels, images=True):
+        """Rebuild the levels in a snapshot as saved levels, so generate()
+        brings them back instead of making new ones. If images is False the
+        walls are left for build_images() to draw."""
+        enemy_types = {'crystal': Crystal, 'archer': Archer, 'charger': Charger, 'dummy': Dummy}
+
+        self.saved_levels = {}
+        for level, data in levels.items():
+            # Every level is the same size
+            self.rect = pyg.rect.Rect((0, 0), data['size'])
+
+            walls = pyg.sprite.Group()
+            for type, x, y in data['walls']:
+                walls.add(Wall(self.window, (x, y), type, 'default'))
+
+            statics = pyg.sprite.Group()
+            up_ladder = down_ladder = None
+            for kind, x, y in data['statics']:
+                if kind == 'fountain':
+                    statics.add(Fountain(self.window, (x, y)))
+                else:
+                    ladder = Ladder(self.window, (x, y), kind.split('_')[1])
+                    if ladder.dir == 'up':
+                        up_ladder = ladder
+                    else:
+                        down_ladder = ladder
+                    statics.add(ladder)
+
+            pickups = pyg.sprite.Group()
+            for type, x, y in data['pickups']:
+                pickups.add(Pickup(self.window, {'image': pickup_assets[type], 'pos': (x, y), 'type': type}))
+
+            enemies = pyg.sprite.Group()
+            crystal = None
+            for kind, x, y, hp, vx, vy in data['enemies']:
+                enemy = enemy_types[kind](self.window, self, (x, y))
+                enemy.hp = hp
+                enemy.vel.x = vx
+                enemy.vel.y = vy
+                if kind == 'crystal':
+                    crystal = enemy
+                enemies.add(enemy)
+
+            rooms = []
+            fogs = pyg.sprite.Group()
+            for y in range(0, self.rect.height, self.room_size[1]):
+                for x in range(0, self.rect.width, self.room_size[0]):
+                    room = Room(self.window, self, pyg.rect.Rect((x, y), self.room_size), 'empty')
+                    if data['fog'][len(rooms)]:
+                        room.fogs.append(RoomFog(self.window, room.rect.center))
+                        fogs.add(room.fogs)
+                    rooms.append(room)
+
+            self.untextured.append(walls)
+
+            self.saved_levels[level] = {'rooms': rooms,
+                                        'walls': walls,
+                                        'statics': statics,
+                                        'sensors': pyg.sprite.Group(),
+                                        'pickups': pickups,
+                                        'enemies': enemies,
+                                        'fogs': fogs,
+                                        'up_ladder': up_ladder,
+                                        'down_ladder': down_ladder,
+                                        'crystal': crystal}
+
+        if images:
+            self.build_images()
 
     def gen_saved_level(self, level, dir):
         self.rooms = []
@@ -1097,24 +2309,229 @@ class World():
         self.down_ladder = self.saved_levels[level]['down_ladder']
         self.crystal = self.saved_levels[level]['crystal']
 
+        self.build_grid()
+        self.index_pickups()
+        self.sensor_system.build()
+        self.particles.clear()
+        self.player_room = None
+        self.ai.reset()
+
         if dir == 'up':
             self.spawn = self.down_ladder.rect.center
-        elif dir == 'down':
+        else:
             self.spawn = self.up_ladder.rect.center
 
-    def trigger(self, type, detail, sensor_rect):
-        """Executes every tick while a sensor is activated."""
+    def build_grid(self):
+        """Split the level into tiles the size of the thinnest wall and
+        record which ones can be walked on, and which ones block sight."""
+        self.grid_w = math.ceil(self.rect.width / self.tile_size)
+        self.grid_h = math.ceil(self.rect.height / self.tile_size)
+        self.walkable = bytearray([1]) * (self.grid_w * self.grid_h)
+        self.opaque = bytearray(self.grid_w * self.grid_h)
+
+        for wall in self.walls:
+            for tile in self.get_tiles(wall.rect):
+                self.walkable[tile] = 0
+                self.opaque[tile] = 1
+        for static in self.statics:
+            for tile in self.get_tiles(static.collide_rect):
+                self.walkable[tile] = 0
+
+        self.solid_index.clear()
+        self.wall_index.clear()
+        for wall in self.walls:
+            self.solid_index.add(wall, wall.collide_rect)
+            self.wall_index.add(wall)
+        for static in self.statics:
+            # Ladders can be walked over
+            if static.collide_rect.width and static.collide_rect.height:
+                self.solid_index.add(static, static.collide_rect)
+
+        self.build_free_floor()
+
+    def sweep(self, rect, dx, dy, walls_only=False):
+        """Find the first wall or static that rect would run into if it
+        moved by (dx, dy), see sweep_rect(). Bullets use walls_only, which
+        checks the whole rect of walls instead of their collide_rect."""
+        if walls_only:
+            found = [(wall, wall.rect) for wall in self.wall_index.query(rect.union(rect.move(dx, dy)))]
+        else:
+            found = [(obj, obj.collide_rect) for obj in self.solid_index.query(rect.union(rect.move(dx, dy)))]
+        # The index is unordered, so sort to pick the same one in a tie
+        found.sort(key=lambda item: (item[1].y, item[1].x))
+        return sweep_rect(rect, dx, dy, found)
+
+    def get_tiles(self, rect):
+        """Return the indexes of every tile that rect overlaps."""
+        if rect.width == 0 or rect.height == 0:
+            return []
+        size = self.tile_size
+        return [ty * self.grid_w + tx
+                for ty in range(max(rect.top // size, 0), min((rect.bottom - 1) // size + 1, self.grid_h))
+                for tx in range(max(rect.left // size, 0), min((rect.right - 1) // size + 1, self.grid_w))]
+
+    def build_free_floor(self):
+        """Make a list of the tiles that things can be spawned on, for the
+        whole level and for each room. A tile is free if it can be walked on
+        and isn't close to a static object like a ladder."""
+        near_statics = set()
+        for static in self.statics:
+            near_statics.update(self.get_tiles(static.rect.inflate(40, 40)))
+
+        self.free_tiles = []
+        self.room_free_tiles = {room: [] for room in self.rooms}
+        for tile, walkable in enumerate(self.walkable):
+            if not walkable or tile in near_statics:
+                continue
+            self.free_tiles.append(tile)
+
+            room = self.room_at(self.get_tile_center(tile))
+            if room is not None:
+                self.room_free_tiles[room].append(tile)
+
+    def random_free_position(self, room=None):
+        """Return a random point on free floor, optionally inside a given
+        room. The point is at least 20px from any wall. Returns None if
+        there is no free floor to choose from."""
+        tiles = self.free_tiles if room is None else self.room_free_tiles.get(room, [])
+        if not tiles:
+            return None
+
+        x, y = self.get_tile_center(random.choice(tiles))
+        margin = self.tile_size//2 - 20
+        return (x + random.randint(-margin, margin), y + random.randint(-margin, margin))
+
+    def index_pickups(self):
+        self.pickup_index.clear()
+        for pickup in self.pickups:
+            self.pickup_index.add(pickup)
+
+    def add_pickup(self, pickup):
+        self.pickups.add(pickup)
+        self.pickup_index.add(pickup)
+
+    def hit_enemies(self):
+        """Hurt every enemy a player bullet is touching. This runs every
+        tick for every enemy, so bullets still hit the ones the AIScheduler
+        only updates now and then."""
+        bullets = [b for b in self.bullets if b.owner == 'player']
+        if not bullets:
+            return
+        enemies = self.enemies.sprites()
+        rects = [e.collide_rect for e in enemies]
+
+        for bullet in bullets:
+            for i in bullet.rect.collidelistall(rects):
+                enemy = enemies[i]
+                if not enemy.alive():
+                    continue
+                enemy.hurt(1)
+                if not bullet.invulnerable:
+                    bullet.kill()
+                    break
+
+    def update_pickups(self, player):
+        """Pull pickups within magnet range towards the player. Only the
+        pickups in the cells around the player are looked at, so the rest of
+        the level costs nothing."""
+        area = pyg.rect.Rect(0, 0, 2 * self.magnet_range, 2 * self.magnet_range)
+        area.center = player.rect.center
+        px, py = player.rect.center
+        range_sq = self.magnet_range**2
+        is_hurt = player.hp < player.max_hp
+
+        moving = set()
+        for pickup in self.pickup_index.query(area):
+            if pickup.type == 'hp':
+                pickup.seek_player = is_hurt
+
+            dx = px - pickup.rect.centerx
+            dy = py - pickup.rect.centery
+            dist = dx*dx + dy*dy
+            if dist < range_sq and pickup.seek_player:
+                dist = math.sqrt(dist) or 1
+                pickup.vel.x += dx / dist
+                pickup.vel.y += dy / dist
+
+                pickup.rect.x += int(pickup.vel.x) * 5
+                pickup.rect.y += int(pickup.vel.y) * 5
+                self.pickup_index.move(pickup)
+                moving.add(pickup)
+
+        # Slow down every pickup that was pulled last tick but not this one,
+        # including any that left the area, so none keep their old speed
+        for pickup in self.moving_pickups - moving:
+            pickup.vel.x *= .5
+            pickup.vel.y *= .5
+            if pickup.vel.length_squared() > .01:
+                moving.add(pickup)
+            else:
+                pickup.vel.update(0, 0)
+        self.moving_pickups = moving
+
+    def get_tile(self, pos):
+        """Return the index of the tile containing pos, or None if pos is
+        outside the level."""
+        tx = int(pos[0]) // self.tile_size
+        ty = int(pos[1]) // self.tile_size
+        if 0 <= tx < self.grid_w and 0 <= ty < self.grid_h:
+            return ty * self.grid_w + tx
+
+    def get_tile_center(self, tile):
+        return ((tile % self.grid_w) * self.tile_size + self.tile_size // 2,
+                (tile // self.grid_w) * self.tile_size + self.tile_size // 2)
+
+    def room_at(self, pos):
+        """Return the room containing pos, or None if it is outside them.
+        Rooms are laid out on a regular grid, so this is just a division."""
+        col = int(pos[0]) // self.room_size[0]
+        row = int(pos[1]) // self.room_size[1]
+        cols = self.rect.width // self.room_size[0]
+        rows = self.rect.height // self.room_size[1]
+        if 0 <= col < cols and 0 <= row < rows:
+            return self.rooms[row * cols + col]
+
+    def add_room_listener(self, listener):
+        """Call listener(old_room, new_room) whenever the player moves into
+        a different room, including when they arrive on a new level."""
+        self.room_listeners.append(listener)
+
+    def track_player(self, player):
+        """Check which room the player is in, and tell the listeners if it
+        has changed since the last tick."""
+        room = self.room_at(player.rect.center)
+        if room is not self.player_room:
+            old_room = self.player_room
+            self.player_room = room
+            for listener in self.room_listeners:
+                listener(old_room, room)
+
+    def reveal_room(self, old_room, new_room):
+        """Clear the fog from a room when the player walks into it."""
+        if new_room is not None:
+            for fog in new_room.fogs:
+                fog.kill()
+
+    def trigger(self, type, detail, sensor_rect, event, entity):
+        """Executes when an entity enters or exits a sensor, and every tick
+        that it stays inside. event is one of 'enter', 'stay' or 'exit'."""
         if type == 'touch':
             ...
 
-    def generate(self, level, dir):
+    def generate(self, level, dir, images=True):
         """Create a given level randomly. Until level 10, use grid
         generation, in which a grid of rooms is created, then a maze is
         constructed that reaches every room.
+
+        If images is False, no surfaces are made or drawn, so it is safe to
+        run on another thread. Call build_images() on the main thread
+        afterwards.
         """
 
         if level in self.saved_levels.keys():
             self.gen_saved_level(level, dir)
+            if images:
+                self.build_images()
             return
 
         self.rooms = []
@@ -1138,11 +2555,10 @@ class World():
         if gen_type == 'grid':
             # Create all the rooms, then make the maze, then set the special
             # rooms, e.g. start, exit, treasure
-            self.image = pyg.Surface((3750, 3000))
-            self.rect = self.image.get_rect()
+            self.rect = pyg.rect.Rect(0, 0, 3750, 3000)
 
-            for y in range(0, self.rect.bottom, 600):
-                for x in range(0, self.rect.right, 750):
+            for y in range(0, self.rect.bottom, self.room_size[1]):
+                for x in range(0, self.rect.right, self.room_size[0]):
                     room = self.create_room('regular', (x, y))
                     self.rooms.append(room)
 
@@ -1230,7 +2646,24 @@ class World():
             self.enemies.add([room.enemies for room in self.rooms])
             self.fogs.add([room.fogs for room in self.rooms])
 
-            self.update_wall_textures()
+            self.untextured.append(self.walls.copy())
+
+        self.build_grid()
+        self.index_pickups()
+        self.sensor_system.build()
+        self.particles.clear()
+        self.player_room = None
+        self.ai.reset()
+
+        if images:
+            self.build_images()
+
+    def build_images(self):
+        """Draw the covers on every wall made by generate() or restore()
+        since the last call."""
+        for walls in self.untextured:
+            self.update_wall_textures(walls)
+        self.untextured = []
 
 
     def get_adj_cells(self, dim_x, dim_y, visited, cur):
@@ -1257,16 +2690,17 @@ class World():
         return adj_cells
 
     def create_room(self, type, pos):
-        size_x = 750
-        size_y = 600
+        size_x, size_y = self.room_size
         room_rect = pyg.rect.Rect(pos[0], pos[1], size_x, size_y)
 
         room = Room(self.window, self, room_rect, type)
 
         return room
 
-    def update_wall_textures(self):
-        for wall in self.walls:
+    def update_wall_textures(self, walls=None):
+        if walls is None:
+            walls = self.walls
+        for wall in walls:
             needed_covers = set(['top', 'bottom', 'left', 'right'])
 
             if wall.rect.top == self.rect.top: # Remove covers if on the edge of the map
@@ -1278,7 +2712,7 @@ class World():
             if wall.rect.left == self.rect.left:
                 needed_covers.discard('left')
 
-            for other in self.walls: # Loop through each wall again to check for connected walls
+            for other in walls: # Loop through each wall again to check for connected walls
                 if wall.rect.y == other.rect.y:
                     if wall.rect.left == other.rect.right:
                         needed_covers.discard('left')
@@ -1390,7 +2824,11 @@ class Room():
         self.fogs = []
 
         assert type in ['regular', 'start', 'exit', 'treasure', 'danger',
-                        'crystal']
+                        'crystal', 'empty']
+
+        # Rooms of a loaded level are filled in by World.restore()
+        if type == 'empty':
+            return
 
          # Create the corners of the room
         pos = [(0, 0),
@@ -1559,26 +2997,36 @@ class StaticObject(pyg.sprite.Sprite):
 
 
 class Wall(StaticObject):
+    # Images of walls with covers drawn on, shared by every wall that needs
+    # the same covers
+    variants = {}
+
     def __init__(self, window, pos, type, theme):
         self.type = type
         self.theme = theme
-        self.image = pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'{self.type}.png')))
+        self.image = wall_assets[f'{theme}/{self.type}']
         super().__init__(window, pos, False)
         self.collide_rect = self.rect.inflate(-20, -30)
         self.collide_rect.bottom -= 5
 
-        self.covers = {'top': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'{self.type}_top.png'))),
-                       'bottom': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'{self.type}_bottom.png'))),
-                       'right': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'{self.type}_right.png'))),
-                       'left': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'{self.type}_left.png'))),
-                       'br': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'corner_br.png'))),
-                       'bl': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'corner_bl.png'))),
-                       'tr': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'corner_tr.png'))),
-                       'tl': pyg.image.load(get_path(os.path.join('assets', 'imgs', 'world', 'walls', theme, f'corner_tl.png')))}
+        self.covers = {'top': wall_assets[f'{theme}/{self.type}_top'],
+                       'bottom': wall_assets[f'{theme}/{self.type}_bottom'],
+                       'right': wall_assets[f'{theme}/{self.type}_right'],
+                       'left': wall_assets[f'{theme}/{self.type}_left'],
+                       'br': wall_assets[f'{theme}/corner_br'],
+                       'bl': wall_assets[f'{theme}/corner_bl'],
+                       'tr': wall_assets[f'{theme}/corner_tr'],
+                       'tl': wall_assets[f'{theme}/corner_tl']}
 
     def add_covers(self, covers):
-        for c in covers:
-            self.image.blit(self.covers[c], (0, 0))
+        key = (self.theme, self.type, frozenset(covers))
+        if key not in Wall.variants:
+            image = wall_assets[f'{self.theme}/{self.type}'].copy()
+            for c in sorted(covers):
+                image.blit(self.covers[c], (0, 0))
+            Wall.variants[key] = image
+
+        self.image = Wall.variants[key]
 
 class Fountain(StaticObject):
     def __init__(self, window, pos):
@@ -1589,6 +3037,7 @@ class Fountain(StaticObject):
 
 class Ladder(StaticObject):
     def __init__(self, window, pos, dir):
+        self.dir = dir
         self.image = static_assets[f'ladder_{dir}']
         super().__init__(window, pos, True)
         # Ladders do not use the collision rect, but a collide_rect
@@ -1597,36 +3046,108 @@ class Ladder(StaticObject):
 
 
 class RoomFog(StaticObject):
+    # Every fog looks the same, so they all share one image. It is made by
+    # load_image() on the main thread, so fogs can be made on any thread.
+    shared_image = None
+
     def __init__(self, window, pos):
         """A class to represent the 'fog of war' effect. It is classified as a
         StaticObject because it does not move, however it differs from other
-        StaticObjects because it has an update(player) method that detects if
-        it has collided with the player. If it does, it kills itself."""
-        self.image = pyg.Surface((750, 600)).convert()
-        self.image.fill((20, 20, 20))
+        StaticObjects because it is killed by World.reveal_room() as soon as
+        the player walks into its room."""
+        self.image = RoomFog.shared_image
         super().__init__(window, pos, True)
         # A collide_rect attribute is required, but it won't be used
         # so set it to zeros
         self.collide_rect = pyg.rect.Rect(0, 0, 0, 0)
 
-    def update(self, player):
-        if self.rect.colliderect(player.rect):
-            self.kill()
+    @classmethod
+    def load_image(cls):
+        if cls.shared_image is None:
+            cls.shared_image = pyg.Surface((750, 600)).convert()
+            cls.shared_image.fill((20, 20, 20))
 
 
 def terminate():
     pyg.quit()
     raise SystemExit()
 
-def get_path(path):
-    """Returns the full file path of a file."""
-    dirname = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(dirname, path)
+def get_mouse_pos():
+    """The mouse position on the game surface rather than the display, as
+    of the start of this tick."""
+    return controls.mouse_pos
+
+def resolution_arg(value):
+    """argparse type for --resolution: 'native' or WIDTHxHEIGHT."""
+    value = value.lower()
+    if value == 'native':
+        return value
+    try:
+        width, height = (int(n) for n in value.split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT or 'native', not {value!r}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f'{value} is too small to render at')
+    return value
+
+def get_render_size(display_size, arg, max_size=(1920, 1080)):
+    """Work out the size to render the game at. By default this is the
+    display size divided by the smallest whole number that makes it fit in
+    max_size, so big monitors are scaled up instead of drawn at full size."""
+    if arg == 'native':
+        return display_size
+    if arg:
+        width, height = arg.lower().split('x')
+        return (int(width), int(height))
+
+    scale = max(math.ceil(display_size[0] / max_size[0]),
+                math.ceil(display_size[1] / max_size[1]), 1)
+    return (display_size[0] // scale, display_size[1] // scale)
+
+def sweep_rect(rect, dx, dy, others):
+    """Move rect by (dx, dy) and find the first of others that it would
+    overlap on the way. others is a list of (obj, rect) pairs. Returns
+    (toi, normal, obj), where toi (time of impact) is the fraction of the
+    move that can be made before touching obj, and normal is the side of
+    obj that was hit, e.g. (-1, 0) for its left side. If nothing is hit,
+    returns (1, None, None). Anything rect already overlaps is ignored, so
+    it can move out."""
+    hit = (1, None, None)
+    for obj, other in others:
+        # The times that the edges on each axis start and stop overlapping
+        if dx > 0:
+            x_entry = (other.left - rect.right) / dx
+            x_exit = (other.right - rect.left) / dx
+        elif dx < 0:
+            x_entry = (other.right - rect.left) / dx
+            x_exit = (other.left - rect.right) / dx
+        elif rect.right > other.left and rect.left < other.right:
+            x_entry, x_exit = -math.inf, math.inf
+        else:
+            continue
+
+        if dy > 0:
+            y_entry = (other.top - rect.bottom) / dy
+            y_exit = (other.bottom - rect.top) / dy
+        elif dy < 0:
+            y_entry = (other.bottom - rect.top) / dy
+            y_exit = (other.top - rect.bottom) / dy
+        elif rect.bottom > other.top and rect.top < other.bottom:
+            y_entry, y_exit = -math.inf, math.inf
+        else:
+            continue
 
-def play_sound(sound):
-    se_channel = pyg.mixer.find_channel()
+        entry = max(x_entry, y_entry)
+        if entry < 0 or entry >= hit[0] or entry >= min(x_exit, y_exit):
+            continue
+
+        if x_entry > y_entry:
+            normal = (-1 if dx > 0 else 1, 0)
+        else:
+            normal = (0, -1 if dy > 0 else 1)
+        hit = (entry, normal, obj)
 
-    se_channel.play(sound)
+    return hit
 
 def toggle_cheat_code(player, cheat_codes, *codes):
     if 'speed' in codes:
@@ -1654,7 +3175,9 @@ def toggle_cheat_code(player, cheat_codes, *codes):
             cheat_codes['invisibility'] = False
 
 def new_dummy(world, type):
-    pos = (random.randint(0, world.rect.width), random.randint(0, world.rect.height))
+    pos = world.random_free_position()
+    if pos is None:
+        return
     if type == 'bounce':
         dummy = Dummy(window, world, pos)
     else:
@@ -1662,16 +3185,12 @@ def new_dummy(world, type):
     world.enemies.add(dummy)
 
 def new_pickup(window, world, pos=None):
-    """Create a random pickup anywhere in the world. Guarantee that one is
-    generated."""
+    """Create a random pickup anywhere on free floor in the world. Returns
+    None if there is no free floor left."""
     if not pos:
-        valid = False
-        while not valid:
-            pos = (random.randint(50, world.rect.width - 50), random.randint(50, world.rect.height - 50))
-            valid = True
-            for sprite in (world.walls.sprites() + world.statics.sprites()):
-                if sprite.rect.inflate(40, 40).collidepoint(pos):
-                    valid = False
+        pos = world.random_free_position()
+        if pos is None:
+            return
 
     type = random.choices(['hp', 'cube'], weights=[1, 2], k=1)[0]
     if type == 'hp':
@@ -1682,6 +3201,46 @@ def new_pickup(window, world, pos=None):
 
     return Pickup(window, data)
 
+def update_world(world, player):
+    """Move everything in the level on by one tick. Nothing is drawn, so
+    this is all a headless game needs to run."""
+    world.update_pickups(player)
+    world.sensor_system.update([player])
+
+    for b in world.bullets:
+        b.update()
+    world.particles.update()
+
+    world.flow.update(player)
+    world.ai.update(player)
+    world.hit_enemies()
+
+    player.update()
+    world.track_player(player)
+    world.fov.update(player)
+
+def render_world(world, world_decor, player, depth_sorter):
+    """Draw everything in the world without updating any of it. Things lying
+    on the floor are drawn first, then everything standing up is drawn from
+    the top of the level down."""
+    world_decor.render_bg()
+
+    # Ladders have no collide_rect because they are flat on the floor
+    floor = [s for s in world.statics if not s.collide_rect.height]
+    standing = [s for s in world.statics if s.collide_rect.height]
+
+    renderer.render(floor)
+    renderer.render_pickups(world.pickups)
+
+    depth_sorter.update((standing, world.walls, world.enemies, world.bullets, [player]),
+                        renderer.window_rect)
+    renderer.render_sorted(depth_sorter.sprites, player)
+    world.particles.render(camera.rect.topleft)
+
+    world.fov.render(window, camera.rect.topleft)
+
+    renderer.render(world.fogs)
+
 def win():
     print('YAY GOOD JOB BUDDY')
     terminate()
@@ -1699,7 +3258,52 @@ def win():
     Minimap label
     """
 
-def main():
+class StartupTimer():
+    def __init__(self, start):
+        """Records how long each part of starting the game takes, up to the
+        first frame being shown."""
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, name):
+        """End the current phase and call it name."""
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        print('Startup report')
+        for name, seconds in self.phases:
+            print(f'  {name:<24}{seconds * 1000:8.1f} ms')
+        print(f'  {"time to first frame":<24}{(self.last - self.start) * 1000:8.1f} ms')
+
+        print('  Asset loading by group (included above)')
+        for name, seconds in sorted(load_times.items(), key=lambda x: -x[1]):
+            print(f'    {name:<22}{seconds * 1000:8.1f} ms')
+
+
+def setup(display, size=None, smooth=False):
+    """Create the globals that the game is drawn, played and heard through.
+    Everything is drawn to window, which screen scales to the display."""
+    global screen, window, WIDTH, HEIGHT, camera, renderer, sound_manager, controls
+
+    screen = Screen(display, size, smooth)
+    window = screen.surface
+    WIDTH, HEIGHT = window.get_size()
+
+    # Init camera outside of main() so we can access it anywhere
+    camera = Camera()
+    renderer = LayerRenderer(window)
+
+    sound_manager = SoundManager(sounds, {'score_up': (3, 40, 1)})
+    controls = Input(screen)
+
+
+def main(startup_timer=None, run=None, save_path=savegame.default_path, fps_limit=FPS):
+    """Play the game, continuing from run if it is given. The run is saved
+    to save_path every time the player takes a ladder, unless it is None.
+    A fps_limit of 0 runs as fast as possible."""
      # Custom mouse pointer
     pyg.mouse.set_visible(False)
     pointer = mouse_assets['pointer']
@@ -1709,21 +3313,54 @@ def main():
     custom_event = pyg.USEREVENT + 1
     pyg.time.set_timer(custom_event, 50)
 
-    cur_level = 1
-    world = World(window)
-    world.generate(cur_level, 'nodir')
+    loading_screen = LoadingScreen(window)
+
+    def load_level(level, dir):
+        """Generate a level while the loading screen is up, then draw its
+        images here, since that needs the display."""
+        loading_screen.run(f'Level {level}', [('generating level',
+                                                lambda: world.generate(level, dir, images=False))])
+        world.build_images()
 
+    cur_level = 1 if run is None else run['level']
+    world = World(window)
     world_decor = WorldDecoration(window, world)
+
+    def new_game():
+        if run is not None:
+            world.restore(run['levels'], images=False)
+        world.generate(cur_level, 'nodir', images=False)
+
+    # Everything a level is made from is loaded first, so the worker only
+    # ever looks up surfaces that already exist
+    for group in level_assets:
+        group.preload()
+    loading_screen.run('NRogue', [('generating level', new_game)])
+    world.build_images()
     world_decor.generate(cur_level)
 
     player = Player(window, world)
     player.rect.center = world.spawn
+    if run is not None:
+        player.restore(run['player'])
+
+    autosaver = savegame.AutoSaver(save_path) if save_path else None
+
+    def autosave():
+        """Snapshot the run now and write it in the background."""
+        if autosaver is None:
+            return
+        autosaver.save({'level': cur_level,
+                        'player': player.snapshot(),
+                        'levels': world.snapshot(cur_level)})
 
     hud = HUD(window, player, cur_level)
     player.add_hud(hud)
 
     render_sensors = False
 
+    depth_sorter = DepthSorter()
+
     textboxes = []
 
     cheat_codes = {'speed': False,
@@ -1735,9 +3372,14 @@ def main():
     paused = False
     pause_menu = PauseMenu(window)
 
+    if startup_timer:
+        startup_timer.mark('level generation')
+
     while True:
+        controls.poll()
+
         if not paused:
-            for event in pyg.event.get():
+            for event in controls.events:
                 if event.type == pyg.QUIT:
                     terminate()
                 elif event.type == pyg.KEYDOWN:
@@ -1755,16 +3397,18 @@ def main():
                             else:
                                 world.save_level(cur_level)
                                 cur_level -= 1
-                                world.generate(cur_level, 'up')
+                                load_level(cur_level, 'up')
                                 player.rect.center = world.spawn
                                 hud.update('level', cur_level)
+                                autosave()
                         elif world.down_ladder != None:
                             if player.collide_rect.colliderect(world.down_ladder.rect):
                                 world.save_level(cur_level)
                                 cur_level += 1
-                                world.generate(cur_level, 'down')
+                                load_level(cur_level, 'down')
                                 player.rect.center = world.spawn
                                 hud.update('level', cur_level)
+                                autosave()
 
                     elif event.key == pyg.K_COMMA:
                         player.cur_weapon = Slingshot(window, world)
@@ -1789,15 +3433,15 @@ def main():
                 #     if event.event == 'WINDOWEVENT_FOCUS_LOST':
                 #         paused = True
 
-            event_keys = pyg.key.get_pressed()
+            event_keys = controls.keys
              # Movement keys
-            if event_keys[pyg.K_LEFT] or event_keys[pyg.K_a]:
+            if pyg.K_LEFT in event_keys or pyg.K_a in event_keys:
                 player.vel.x -= player.speed
-            if event_keys[pyg.K_RIGHT] or event_keys[pyg.K_d]:
+            if pyg.K_RIGHT in event_keys or pyg.K_d in event_keys:
                 player.vel.x += player.speed
-            if event_keys[pyg.K_UP] or event_keys[pyg.K_w]:
+            if pyg.K_UP in event_keys or pyg.K_w in event_keys:
                 player.vel.y -= player.speed
-            if event_keys[pyg.K_DOWN] or event_keys[pyg.K_s]:
+            if pyg.K_DOWN in event_keys or pyg.K_s in event_keys:
                 player.vel.y += player.speed
 
              # Create textboxes for ladder collisions
@@ -1814,39 +3458,12 @@ def main():
             camera.follow(player)
             camera.apply_lens(player, world, world_decor)
 
-            world_decor.render_bg()
+            update_world(world, player)
 
-            for p in world.pickups:
-                p.update(player)
-                p.render()
-
-            # for s in world.sensors:
-            #     s.update(player)
-            # if render_sensors:
-            #     for s in world.sensors:
-            #         s.render()
-
-            for s in world.statics:
-                s.render()
-
-            for b in world.bullets:
-                b.update()
-                b.render()
-
-            for e in world.enemies:
-                e.update(player)
-            for e in world.enemies:
-                e.render()
-
-            player.update()
-            player.render()
-
-            for w in world.walls:
-                w.render()
-
-            for f in world.fogs:
-                f.update(player)
-                f.render()
+            render_world(world, world_decor, player, depth_sorter)
+            if render_sensors:
+                for s in world.sensors:
+                    s.render()
 
             for t in textboxes:
                 t.render()
@@ -1855,19 +3472,37 @@ def main():
             hud.update('fps', round(clock.get_fps()))
             hud.render()
 
-            pointer_rect.center = pyg.mouse.get_pos()
+            pointer_rect.center = get_mouse_pos()
             window.blit(pointer, pointer_rect)
 
-            pyg.display.flip()
-            clock.tick(FPS)
+            screen.present()
+            clock.tick(fps_limit)
+
+            if startup_timer:
+                startup_timer.mark('first frame')
+                startup_timer.report()
+                startup_timer = None
 
         else: # If paused
-            for event in pyg.event.get():
+            if pause_menu.frame is None:
+                # Draw the world one last time without the pointer, then
+                # keep it as the background of the menu
+                render_world(world, world_decor, player, depth_sorter)
+                hud.update('fps', round(clock.get_fps()))
+                hud.render()
+                pause_menu.freeze()
+
+                pointer_rect.center = get_mouse_pos()
+                window.blit(pointer, pointer_rect)
+                screen.present()
+
+            for event in controls.events:
                 if event.type == pyg.QUIT:
                     terminate()
                 elif event.type == pyg.KEYDOWN:
                     if event.key == pyg.K_ESCAPE:
                         paused = False
+                        pause_menu.unfreeze()
                     elif event.key == pyg.K_BACKQUOTE:
                         terminate()
                 elif event.type == pyg.MOUSEBUTTONDOWN:
@@ -1877,61 +3512,112 @@ def main():
                                 terminate()
                             elif button[2] == 'CONTINUE':
                                 paused = False
+                                pause_menu.unfreeze()
                             # elif button[2] == 'OPTIONS':
                             #     print('OPTIONS')
 
-            world_decor.render_bg()
+            if paused:
+                dirty = pause_menu.update()
 
-            for p in world.pickups:
-                p.render()
+                # Only the pointer and any buttons that changed are redrawn
+                m_pos = get_mouse_pos()
+                if dirty or m_pos != pointer_rect.center:
+                    dirty.append(pointer_rect.copy())
+                    pause_menu.render(dirty)
 
-            for b in world.bullets.sprites():
-                b.render()
+                    pointer_rect.center = m_pos
+                    window.blit(pointer, pointer_rect)
+                    dirty.append(pointer_rect.copy())
 
-            # if render_sensors:
-            #     for s in world.sensors:
-            #         s.render()
+                    screen.present(dirty)
 
-            for s in world.statics:
-                s.render()
-
-            for e in world.enemies:
-                e.render()
-
-            player.render()
-
-            for w in world.walls:
-                w.render()
-
-            for f in world.fogs:
-                f.render()
-
-            hud.update('fps', round(clock.get_fps()))
-            hud.render()
-
-            pause_menu.update()
-            pause_menu.render()
-
-            pointer_rect.center = pyg.mouse.get_pos()
-            window.blit(pointer, pointer_rect)
-
-            pyg.display.flip()
-
-            clock.tick(FPS)
+            clock.tick(fps_limit)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NRogue')
+    parser.add_argument('--resolution', type=resolution_arg, default=None,
+                        help="size to render the game at, e.g. 1280x720, or 'native'")
+    parser.add_argument('--smooth', action='store_true',
+                        help='smoothly scale the game to fit the display')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='print how long each part of startup took')
+    parser.add_argument('--continue', dest='resume', action='store_true',
+                        help='continue the last autosaved run')
+    parser.add_argument('--load', metavar='PATH',
+                        help='continue the run saved at PATH, and autosave there')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for the random numbers of a new run')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the input of a new run to PATH')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='play back the run recorded at PATH, then print how long it took')
+    parser.add_argument('--headless', action='store_true',
+                        help='play back a replay without a window, as fast as possible')
+    parser.add_argument('--max-speed', action='store_true',
+                        help="don't limit the frame rate")
+    args = parser.parse_args()
+
+    save_path = args.load or savegame.default_path
+    run = None
+    if args.load or (args.resume and os.path.exists(save_path)):
+        if args.record or args.replay:
+            parser.error("recordings always start a new run, so can't be combined with a saved one")
+        try:
+            run = savegame.read(save_path)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't load {save_path}: {e}")
+
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    if args.record and not -2**63 <= seed < 2**63:
+        parser.error('--seed must fit in a signed 64 bit number to be recorded')
+    resolution = args.resolution
+    fps_limit = 0 if args.max_speed else FPS
+    if args.replay:
+        try:
+            reader = replay.Reader(args.replay)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't load {args.replay}: {e}")
+        # The mouse is recorded on the game surface, so play it back at the
+        # same size
+        seed = reader.seed
+        resolution = f'{reader.size[0]}x{reader.size[1]}'
+        # Don't overwrite the real autosave
+        save_path = None
+        if args.headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
+            fps_limit = 0
+    elif args.headless:
+        parser.error('--headless only works with --replay')
+    random.seed(seed)
+
+    startup_timer = StartupTimer(start_time)
+    startup_timer.mark('module import')
+
     pyg.mixer.pre_init(44100, -16, 2, 512)
     pyg.mixer.init()
     pyg.init()
+    startup_timer.mark('pygame init')
+
     pyg.display.set_caption("NRogue")
-    window = pyg.display.set_mode(flags=pyg.HWSURFACE | pyg.FULLSCREEN | pyg.DOUBLEBUF)
-    WIDTH, HEIGHT = pyg.display.get_window_size()
+    display = pyg.display.set_mode(flags=pyg.HWSURFACE | pyg.FULLSCREEN | pyg.DOUBLEBUF)
 
-    # Init camera outside of main() so we can access it anywhere
-    camera = Camera()
+    setup(display, get_render_size(display.get_size(), resolution), args.smooth)
+
+    if args.replay:
+        controls = InputReplay(screen, reader)
+    elif args.record:
+        controls = InputRecorder(screen, args.record, seed)
+
+    startup_timer.mark('display init')
 
-    # Import assets after pygame is initalized
-    from asset_loader import *
+    # Images are decoded on worker threads behind the loading screen, then
+    # converted here, since that needs the display
+    LoadingScreen(window).run('NRogue', [(f'loading {group.name}', group.decode) for group in first_frame_assets])
+    startup_timer.mark('asset decoding')
+    for group in first_frame_assets:
+        group.preload()
+        startup_timer.mark(f'assets: {group.name}')
 
-    main()
+    main(startup_timer if args.startup_report else None, run, save_path, fps_limit)
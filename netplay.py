@@ -0,0 +1,750 @@
+"""Run the simulation in one process and draw it in another, over a socket
+on this machine.
+
+The server steps a game at a fixed rate and sends every client a snapshot
+of it each tick. A snapshot only holds what changed since the last one the
+client said it has, so things that stand still cost nothing. The client
+draws the game from the snapshots and sends back its input, or just what
+it has seen if it is only watching, e.g.
+    python netplay.py server
+    python netplay.py client
+    python netplay.py client --spectate
+"""
+import argparse
+import math
+import select
+import socket
+import struct
+import time
+import weakref
+
+import pygame as pyg
+
+import environment
+import main
+import savegame
+
+
+default_port = 5210
+
+# Every message is the length of its body and its type, then the body.
+#   LEVEL       server to client when a level starts, the level as savegame
+#               encodes it, with the player
+#   SNAPSHOT    server to client every tick, see encode()
+#   ACK         client to server, the newest tick the client has
+#   INPUT       client to server, the newest tick and the player's input
+# All little endian.
+message_header = struct.Struct('<IB')
+
+LEVEL = 0
+SNAPSHOT = 1
+ACK = 2
+INPUT = 3
+
+ack_record = struct.Struct('<I')
+# Ack, move x, move y, fire, aim, interact
+input_record = struct.Struct('<IbbBBB')
+
+# A snapshot starts with its tick and the tick it is a delta from, or 0 if
+# it is the whole state. Then come the fields of the game that changed, with
+# a bit for each one that follows. Then for each table: how many entities
+# were removed and how many changed, the ids of the removed ones, and for
+# each changed one its id, a bit for each field that follows, and the fields.
+snapshot_header = struct.Struct('<II')
+game_mask = struct.Struct('<H')
+table_header = struct.Struct('<HH')
+entity_header = struct.Struct('<HB')
+
+# Positions are whole pixels and angles 1/256ths of a turn, so everything
+# fits in a few bytes. Fields are struct format characters.
+game_fields = ['level', 'fog', 'x', 'y', 'hp', 'max_hp', 'score', 'weapon', 'has_crystal', 'aim']
+game_format = 'BIhhBBiBBB'
+tables = {'enemies': 'Bhhb',   # kind, center x, y, hp
+          'bullets': 'BhhB',   # kind, center x, y, direction
+          'pickups': 'Bhh'}    # type, x, y
+
+# Names are sent as their index in these lists
+enemy_kinds = savegame.enemy_kinds
+pickup_types = savegame.pickup_types
+weapons = savegame.weapons
+bullet_kinds = ['pebble', 'arrow', 'laser']
+
+# How many ticks of states are kept to make deltas from
+history = 64
+
+
+def quantize_angle(angle):
+    return round(angle / math.tau * 256) % 256
+
+def dequantize_angle(value):
+    return value * math.tau / 256
+
+
+# Structs for each combination of fields, made the first time they're needed
+field_structs = {}
+
+def get_struct(format, mask):
+    key = (format, mask)
+    if key not in field_structs:
+        field_structs[key] = struct.Struct('<' + ''.join(c for i, c in enumerate(format) if mask >> i & 1))
+    return field_structs[key]
+
+
+def pack_changes(format, old, new):
+    """Return a bit for each field of new that differs from old, and those
+    fields packed. If old is None every field is packed."""
+    mask = 0
+    values = []
+    for i, value in enumerate(new):
+        if old is None or old[i] != value:
+            mask |= 1 << i
+            values.append(value)
+    return mask, get_struct(format, mask).pack(*values)
+
+
+def unpack_changes(format, old, mask, data, offset):
+    """The opposite of pack_changes(). Returns the new fields and the offset
+    after them."""
+    record = get_struct(format, mask)
+    values = iter(record.unpack_from(data, offset))
+    if old is None:
+        if mask != (1 << len(format)) - 1:
+            raise ValueError('snapshot changes an entity that was never sent')
+        return tuple(values), offset + record.size
+    return tuple(next(values) if mask >> i & 1 else old[i] for i in range(len(format))), offset + record.size
+
+
+def encode(tick, state, base_tick=0, base=None):
+    """Pack a state into a snapshot. If base is given, only what changed
+    since it is packed, and the client must have base to unpack it."""
+    parts = [snapshot_header.pack(tick, base_tick if base is not None else 0)]
+
+    mask, fields = pack_changes(game_format, base and base['game'], state['game'])
+    parts.append(game_mask.pack(mask))
+    parts.append(fields)
+
+    for name, format in tables.items():
+        entities = state[name]
+        old = base[name] if base is not None else {}
+        removed = [id for id in old if id not in entities]
+        changed = []
+        for id, entity in entities.items():
+            old_entity = old.get(id)
+            if entity != old_entity:
+                mask, fields = pack_changes(format, old_entity, entity)
+                changed.append(entity_header.pack(id, mask) + fields)
+
+        parts.append(table_header.pack(len(removed), len(changed)))
+        parts.append(struct.pack(f'<{len(removed)}H', *removed))
+        parts.extend(changed)
+
+    return b''.join(parts)
+
+
+def decode(data, states):
+    """Unpack a snapshot into its tick and the whole state. states maps the
+    ticks the client has to their states, and must have the one the
+    snapshot is a delta from. Raises ValueError if it doesn't, or if the
+    snapshot refers to entities that aren't in it."""
+    tick, base_tick = snapshot_header.unpack_from(data)
+    offset = snapshot_header.size
+    if base_tick:
+        base = states.get(base_tick)
+        if base is None:
+            raise ValueError(f'snapshot {tick} is a delta from {base_tick}, which is gone')
+    else:
+        base = None
+
+    mask, = game_mask.unpack_from(data, offset)
+    game, offset = unpack_changes(game_format, base and base['game'], mask, data, offset + game_mask.size)
+    state = {'game': game}
+
+    for name, format in tables.items():
+        entities = dict(base[name]) if base is not None else {}
+        num_removed, num_changed = table_header.unpack_from(data, offset)
+        offset += table_header.size
+        for id in struct.unpack_from(f'<{num_removed}H', data, offset):
+            if entities.pop(id, None) is None:
+                raise ValueError('snapshot removes an entity that was never sent')
+        offset += 2 * num_removed
+        for i in range(num_changed):
+            id, mask = entity_header.unpack_from(data, offset)
+            entities[id], offset = unpack_changes(format, entities.get(id), mask, data,
+                                                  offset + entity_header.size)
+        state[name] = entities
+
+    if offset != len(data):
+        raise ValueError('snapshot has trailing data')
+    return tick, state
+
+
+class Simulation():
+    def __init__(self, seed=None):
+        """A game and the states it has been in for the last few ticks. Each
+        tick the state is captured as plain numbers, which snapshot() turns
+        into a delta from whatever tick a client last had."""
+        self.env = environment.NRogueEnv(seed, max_ticks=math.inf)
+        self.env.reset()
+
+        # Enemies and pickups get an id the first time they're seen, kept
+        # for as long as they exist. Bullets are ids into the pool already.
+        self.ids = weakref.WeakKeyDictionary()
+        self.next_id = 0
+
+        self.aim = 0
+        self.tick = 0
+        self.states = {}
+        self.snapshots = {}
+
+        self.capture_time = 0
+        self.encode_time = 0
+        self.num_encoded = 0
+
+        self.record()
+
+    def get_id(self, sprite):
+        try:
+            return self.ids[sprite]
+        except KeyError:
+            id = self.ids[sprite] = self.next_id
+            self.next_id = (self.next_id + 1) % 65536
+            return id
+
+    def step(self, action):
+        """Play a tick with an action like NRogueEnv.step() takes. A game
+        that ends is started again."""
+        self.aim = action[3]
+        obs, reward, done, info = self.env.step(action)
+        if done:
+            self.env.reset()
+        self.record()
+
+    def record(self):
+        start = time.perf_counter()
+        self.tick += 1
+        self.states[self.tick] = self.capture()
+        self.states.pop(self.tick - history, None)
+        self.snapshots = {}
+        self.capture_time += time.perf_counter() - start
+
+    def capture(self):
+        """The state of the game this tick, as tuples of small numbers."""
+        world = self.env.world
+        player = self.env.player
+
+        fog = 0
+        for i, room in enumerate(world.rooms):
+            if any(f.alive() for f in room.fogs):
+                fog |= 1 << i
+
+        weapon = 'lasergun' if isinstance(player.cur_weapon, main.LaserGun) else 'slingshot'
+        game = (self.env.level, fog, *player.rect.center, player.hp, player.max_hp, player.score,
+                weapons.index(weapon), player.has_crystal, quantize_angle(self.aim))
+
+        enemies = {self.get_id(e): (enemy_kinds.index(type(e).__name__.lower()), *e.rect.center, e.hp)
+                   for e in world.enemies}
+
+        bullets = {}
+        for bullet in world.bullets:
+            if bullet.owner != 'player':
+                kind = 1
+            elif bullet.speed:
+                kind = 0
+            else:
+                kind = 2
+            bullets[bullet.index] = (kind, *bullet.rect.center,
+                                     quantize_angle(math.atan2(bullet.vel.y, bullet.vel.x)))
+
+        pickups = {self.get_id(p): (pickup_types.index(p.type), *p.rect.topleft) for p in world.pickups}
+
+        return {'game': game, 'enemies': enemies, 'bullets': bullets, 'pickups': pickups}
+
+    @property
+    def state(self):
+        return self.states[self.tick]
+
+    def snapshot(self, acked):
+        """The snapshot of this tick for a client that last had tick acked.
+        Clients that have the same tick share the same bytes."""
+        base = self.states.get(acked)
+        base_tick = acked if base is not None else 0
+        if base_tick not in self.snapshots:
+            start = time.perf_counter()
+            self.snapshots[base_tick] = encode(self.tick, self.state, base_tick, base)
+            self.encode_time += time.perf_counter() - start
+            self.num_encoded += 1
+        return self.snapshots[base_tick]
+
+    def level_data(self):
+        """The current level and the player, for a client to build it from."""
+        level = self.env.level
+        return savegame.encode({'level': level,
+                                'player': self.env.player.snapshot(),
+                                'levels': {level: self.env.world.snapshot(level)[level]}})
+
+
+class Connection():
+    def __init__(self, sock, timeout=1):
+        """Sends and receives whole messages over a socket. Sends give up
+        after timeout seconds, so a stuck client can't stop the server."""
+        sock.settimeout(timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.buffer = bytearray()
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, type, body=b''):
+        data = message_header.pack(len(body), type) + body
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def receive(self):
+        """Return every whole message that has arrived, as (type, body)
+        pairs, without waiting for more. Raises ConnectionError if the other
+        end has gone."""
+        while select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('connection closed')
+            self.buffer += data
+            self.bytes_received += len(data)
+
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= message_header.size:
+            length, type = message_header.unpack_from(self.buffer, offset)
+            end = offset + message_header.size + length
+            if end > len(self.buffer):
+                break
+            messages.append((type, bytes(self.buffer[offset + message_header.size:end])))
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+    def close(self):
+        self.sock.close()
+
+
+class Server():
+    def __init__(self, port=default_port, seed=None, rate=main.FPS):
+        """Steps a Simulation rate times a second and sends each client a
+        snapshot every tick. Only this machine can connect. Any client can
+        send input, and the newest input plays the player."""
+        self.sim = Simulation(seed)
+        self.rate = rate
+
+        self.listener = socket.create_server(('127.0.0.1', port))
+        self.listener.setblocking(False)
+        self.clients = {}
+        self.opaque = self.sim.env.world.opaque
+
+        # Fire and interact are held until a tick uses them, so a click
+        # between ticks isn't lost
+        self.action = [0, 0, 0, 0, 0]
+
+        self.step_time = 0
+        self.ticks = 0
+        self.bytes_sent = 0
+        self.snapshots_sent = 0
+
+    def run(self, ticks=None):
+        """Serve until ticks have passed, or forever. Stops early if the
+        process is told to quit, which pygame turns into a QUIT event."""
+        next_tick = time.perf_counter()
+        while ticks is None or self.ticks < ticks:
+            if pyg.event.get(pyg.QUIT):
+                return
+            self.accept()
+            self.receive()
+            self.step()
+
+            next_tick += 1 / self.rate
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Too slow to keep up, so don't try to catch up either
+                next_tick = time.perf_counter()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            client = Connection(sock)
+            # A client has nothing yet, so its first snapshot is the whole state
+            self.clients[client] = 0
+            self.send(client, LEVEL, self.sim.level_data())
+
+    def receive(self):
+        for client in list(self.clients):
+            try:
+                messages = client.receive()
+            except OSError:
+                self.drop(client)
+                continue
+
+            try:
+                for type, body in messages:
+                    if type == ACK:
+                        self.clients[client], = ack_record.unpack(body)
+                    elif type == INPUT:
+                        acked, move_x, move_y, fire, aim, interact = input_record.unpack(body)
+                        self.clients[client] = acked
+                        self.action = [move_x, move_y, fire or self.action[2],
+                                       dequantize_angle(aim), interact or self.action[4]]
+            except struct.error:
+                # A message of the wrong size, so nothing after it can be trusted
+                self.drop(client)
+
+    def step(self):
+        start = time.perf_counter()
+        self.sim.step(self.action)
+        self.action[2] = self.action[4] = 0
+        self.ticks += 1
+
+        world = self.sim.env.world
+        if world.opaque is not self.opaque:
+            # A new level, or a new game
+            self.opaque = world.opaque
+            level_data = self.sim.level_data()
+            for client in list(self.clients):
+                self.send(client, LEVEL, level_data)
+
+        for client, acked in list(self.clients.items()):
+            snapshot = self.sim.snapshot(acked)
+            if self.send(client, SNAPSHOT, snapshot):
+                self.bytes_sent += message_header.size + len(snapshot)
+                self.snapshots_sent += 1
+        self.step_time += time.perf_counter() - start
+
+    def send(self, client, type, body):
+        if client not in self.clients:
+            return False
+        try:
+            client.send(type, body)
+        except OSError:
+            self.drop(client)
+            return False
+        return True
+
+    def drop(self, client):
+        self.clients.pop(client, None)
+        client.close()
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.listener.close()
+
+    def report(self):
+        sim = self.sim
+        ticks = max(self.ticks, 1)
+        print('Server report')
+        print(f'  ticks                 {self.ticks}')
+        print(f'  tick                  {self.step_time / ticks * 1000:8.3f} ms')
+        print(f'  capture               {sim.capture_time / ticks * 1e6:8.1f} us')
+        print(f'  encode                {sim.encode_time / max(sim.num_encoded, 1) * 1e6:8.1f} us per snapshot')
+        print(f'  snapshots sent        {self.snapshots_sent}')
+        print(f'  bytes per snapshot    {self.bytes_sent / max(self.snapshots_sent, 1):8.1f}')
+
+
+class Client():
+    # Enemies and bullets are drawn with these
+    enemy_types = {'crystal': main.Crystal, 'archer': main.Archer,
+                   'charger': main.Charger, 'dummy': main.Dummy}
+
+    def __init__(self, host='127.0.0.1', port=default_port, spectate=False):
+        """Draws a game from the snapshots a Server sends. The level is built
+        once from the data sent when it starts, then the player, enemies,
+        bullets and pickups are moved to where each snapshot says. The
+        client only draws, nothing in it is simulated. Unless spectate is
+        True the player is played from here."""
+        self.connection = Connection(socket.create_connection((host, port)))
+        self.spectate = spectate
+
+        self.states = {}
+        self.tick = 0
+        self.synced = None
+        self.world = None
+
+        self.arrows = {}
+        self.laser = pyg.Surface((1, 1))
+
+        self.snapshots = 0
+        self.snapshot_bytes = 0
+        self.bad_snapshots = 0
+        self.decode_time = 0
+
+    def load_level(self, data):
+        run = savegame.decode(data)
+        level = run['level']
+        window = main.window
+
+        self.world = main.World(window)
+        self.world.restore(run['levels'])
+        self.world.generate(level, 'nodir')
+        # Everything that moves comes from the snapshots instead
+        self.world.enemies.empty()
+        self.world.pickups.empty()
+        self.world.index_pickups()
+
+        self.world_decor = main.WorldDecoration(window, self.world)
+        self.world_decor.generate(level)
+
+        self.player = main.Player(window, self.world)
+        self.player.restore(run['player'])
+        self.hud = main.HUD(window, self.player, level)
+        self.player.add_hud(self.hud)
+        self.hud.update('level', level)
+
+        self.depth_sorter = main.DepthSorter()
+        self.enemies = {}
+        self.pickups = {}
+        self.synced = None
+
+    def receive(self):
+        """Handle every message that has arrived. Returns True if there is a
+        new state to draw. Raises ValueError if a level can't be read."""
+        new_state = False
+        for type, body in self.connection.receive():
+            if type == LEVEL:
+                self.load_level(body)
+            elif type == SNAPSHOT:
+                start = time.perf_counter()
+                try:
+                    tick, state = decode(body, self.states)
+                except (ValueError, struct.error):
+                    # Ack nothing, so the server sends the whole state next
+                    self.bad_snapshots += 1
+                    self.tick = 0
+                    new_state = False
+                    continue
+                self.decode_time += time.perf_counter() - start
+                self.snapshots += 1
+                self.snapshot_bytes += message_header.size + len(body)
+
+                self.states[tick] = state
+                self.states.pop(tick - history, None)
+                self.tick = tick
+                new_state = True
+        return new_state and self.world is not None
+
+    def send_input(self, fire, interact):
+        if self.spectate:
+            self.connection.send(ACK, ack_record.pack(self.tick))
+            return
+
+        keys = main.controls.keys
+        move_x = ((pyg.K_RIGHT in keys or pyg.K_d in keys) -
+                  (pyg.K_LEFT in keys or pyg.K_a in keys))
+        move_y = ((pyg.K_DOWN in keys or pyg.K_s in keys) -
+                  (pyg.K_UP in keys or pyg.K_w in keys))
+        m_pos = main.get_mouse_pos()
+        aim = math.atan2(m_pos[1] - self.player.draw_rect.centery, m_pos[0] - self.player.draw_rect.centerx)
+        self.connection.send(INPUT, input_record.pack(self.tick, move_x, move_y, fire,
+                                                      quantize_angle(aim), interact))
+
+    def sync(self, state):
+        """Move everything to where state says, only touching what changed
+        since the last state."""
+        old = self.synced or {'game': None, 'enemies': {}, 'bullets': {}, 'pickups': {}}
+        world = self.world
+        window = main.window
+
+        game = state['game']
+        if game != old['game']:
+            level, fog, x, y, hp, max_hp, score, weapon, has_crystal, aim = game
+            player = self.player
+            player.rect.center = (x, y)
+            player.collide_rect.center = player.rect.center
+            if (hp, max_hp) != (player.hp, player.max_hp):
+                player.hp = hp
+                player.max_hp = max_hp
+                self.hud.update('hp')
+            if score != player.score:
+                player.score = score
+                self.hud.update('score')
+            player.has_crystal = bool(has_crystal)
+            if weapons[weapon] == 'lasergun' and not isinstance(player.cur_weapon, main.LaserGun):
+                player.cur_weapon = main.LaserGun(window, world)
+            elif weapons[weapon] == 'slingshot' and not isinstance(player.cur_weapon, main.Slingshot):
+                player.cur_weapon = main.Slingshot(window, world)
+            player.set_image('right' if math.cos(dequantize_angle(aim)) >= 0 else 'left')
+
+            for i, room in enumerate(world.rooms):
+                if not fog >> i & 1:
+                    for f in room.fogs:
+                        f.kill()
+
+        for id in old['enemies'].keys() - state['enemies'].keys():
+            self.enemies.pop(id).kill()
+        for id, entity in state['enemies'].items():
+            old_entity = old['enemies'].get(id)
+            if entity == old_entity:
+                continue
+            kind, x, y, hp = entity
+            if old_entity is None or old_entity[0] != kind:
+                if id in self.enemies:
+                    self.enemies[id].kill()
+                self.enemies[id] = self.enemy_types[enemy_kinds[kind]](window, world, (x, y))
+                world.enemies.add(self.enemies[id])
+            enemy = self.enemies[id]
+            enemy.rect.center = (x, y)
+            enemy.collide_rect.center = enemy.rect.center
+            enemy.hp = hp
+
+        pool = world.bullets
+        for id in old['bullets'].keys() - state['bullets'].keys():
+            pool.release(pool.bullets[id])
+        for id, entity in state['bullets'].items():
+            if entity != old['bullets'].get(id):
+                self.set_bullet(pool, pool.bullets[id], *entity)
+
+        for id in old['pickups'].keys() - state['pickups'].keys():
+            self.pickups.pop(id).kill()
+        for id, entity in state['pickups'].items():
+            old_entity = old['pickups'].get(id)
+            if entity == old_entity:
+                continue
+            type, x, y = entity
+            if old_entity is None or old_entity[0] != type:
+                if id in self.pickups:
+                    self.pickups[id].kill()
+                self.pickups[id] = main.Pickup(window, {'image': main.pickup_assets[pickup_types[type]],
+                                                        'pos': (x, y), 'type': pickup_types[type]})
+                world.add_pickup(self.pickups[id])
+            self.pickups[id].rect.topleft = (x, y)
+
+        self.synced = state
+
+    def set_bullet(self, pool, bullet, kind, x, y, angle):
+        """Show a bullet from the pool, without firing it."""
+        if not bullet.is_alive:
+            bullet.is_alive = True
+            pool.free.remove(bullet.index)
+            pool.active[bullet.index] = bullet
+
+        kind = bullet_kinds[kind]
+        if kind == 'pebble':
+            bullet.owner = 'player'
+            bullet.image = main.slingshot_assets['pebble']
+            bullet.rect.size = bullet.image.get_size()
+        elif kind == 'arrow':
+            bullet.owner = 'enemy'
+            arrow = main.archer_assets['arrow']
+            if angle not in self.arrows:
+                self.arrows[angle] = pyg.transform.rotate(arrow, -math.degrees(dequantize_angle(angle)))
+            bullet.image = self.arrows[angle]
+            bullet.rect.size = arrow.get_size()
+        else:
+            bullet.owner = 'player'
+            bullet.image = self.laser
+            bullet.rect.size = (20, 20)
+        bullet.rect.center = (x, y)
+        bullet.draw_rect = bullet.rect
+
+    def run(self):
+        pyg.mouse.set_visible(False)
+        pointer = main.mouse_assets['pointer']
+        pointer_rect = pointer.get_rect()
+        clock = pyg.time.Clock()
+        window = main.window
+        camera = main.camera
+
+        fire = interact = False
+        while True:
+            main.controls.poll()
+            for event in main.controls.events:
+                if event.type == pyg.QUIT:
+                    return
+                elif event.type == pyg.KEYDOWN:
+                    if event.key in (pyg.K_ESCAPE, pyg.K_BACKQUOTE):
+                        return
+                    elif event.key == pyg.K_f:
+                        interact = True
+                elif event.type == pyg.MOUSEBUTTONDOWN:
+                    if event.button == 1:
+                        fire = True
+
+            if self.receive():
+                self.sync(self.states[self.tick])
+            if self.synced is None:
+                clock.tick(main.FPS)
+                continue
+            self.send_input(fire, interact)
+            fire = interact = False
+
+            player = self.player
+            world = self.world
+            camera.follow(player)
+            camera.apply_lens(player, world, self.world_decor)
+            world.fov.update(player)
+
+            # Point the weapon where the player is aiming, which is the
+            # mouse unless spectating
+            m_pos = main.controls.mouse_pos
+            aim = dequantize_angle(self.synced['game'][-1])
+            main.controls.mouse_pos = (int(player.draw_rect.centerx + math.cos(aim) * 200),
+                                       int(player.draw_rect.centery + math.sin(aim) * 200))
+            player.cur_weapon.set_pos(player.draw_rect)
+            main.controls.mouse_pos = m_pos
+
+            main.render_world(world, self.world_decor, player, self.depth_sorter)
+            self.hud.update('pos')
+            self.hud.update('fps', round(clock.get_fps()))
+            self.hud.render()
+
+            pointer_rect.center = m_pos
+            window.blit(pointer, pointer_rect)
+            main.screen.present()
+            clock.tick(main.FPS)
+
+    def report(self):
+        print('Client report')
+        print(f'  snapshots             {self.snapshots}')
+        print(f'  bad snapshots         {self.bad_snapshots}')
+        print(f'  bytes per snapshot    {self.snapshot_bytes / max(self.snapshots, 1):8.1f}')
+        print(f'  decode                {self.decode_time / max(self.snapshots, 1) * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('mode', choices=['server', 'client'])
+    parser.add_argument('--host', default='127.0.0.1', help='server to connect to')
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--seed', type=int, default=None, help='seed for the server\'s game')
+    parser.add_argument('--rate', type=int, default=main.FPS, help='ticks per second on the server')
+    parser.add_argument('--spectate', action='store_true', help='watch without playing')
+    parser.add_argument('--resolution', type=main.resolution_arg, default='1280x720', help='size of the client window')
+    args = parser.parse_args()
+
+    if args.mode == 'server':
+        server = Server(args.port, args.seed, args.rate)
+        print(f'Serving on 127.0.0.1:{args.port}')
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+        server.report()
+    else:
+        pyg.init()
+        pyg.display.set_caption('NRogue')
+        size = main.get_render_size((1920, 1080), args.resolution)
+        main.setup(pyg.display.set_mode(size))
+
+        try:
+            client = Client(args.host, args.port, args.spectate)
+        except OSError as e:
+            parser.error(f"can't connect to {args.host}:{args.port}: {e}")
+        try:
+            client.run()
+        except ConnectionError:
+            print('Lost the connection to the server')
+        except ValueError as e:
+            print(f"Can't read the level the server sent: {e}")
+        client.report()
@@ -0,0 +1,131 @@
+import atexit
+import struct
+import zlib
+
+
+# File layout, all little endian: a header, then a zlib stream of ticks.
+# Each tick starts with a byte of flags saying what changed since the last
+# tick, followed by only the parts that changed:
+#   held keys   a bit for each key the game checks is held down
+#   mouse       how far the mouse moved
+#   events      how many, then each one as its type and arguments
+# A tick where nothing happened is a single zero byte, which compresses to
+# almost nothing.
+magic = b'NRIN'
+version = 1
+
+# The seed is signed, since --seed can be negative
+header = struct.Struct('<4sHqHHB')
+
+KEYS_CHANGED = 1
+MOUSE_MOVED = 2
+HAS_EVENTS = 4
+
+keys_record = struct.Struct('<H')
+mouse_record = struct.Struct('<hh')
+count_record = struct.Struct('<B')
+
+# Event types and the records that follow them
+QUIT = 0
+KEYDOWN = 1
+MOUSEBUTTONDOWN = 2
+event_records = {QUIT: struct.Struct('<'),
+                 KEYDOWN: struct.Struct('<I'),
+                 MOUSEBUTTONDOWN: struct.Struct('<Bhh')}
+
+
+class Writer():
+    def __init__(self, path, seed, size, fps, flush_every=300):
+        """Writes a recording one tick at a time. The stream is flushed to
+        disk every flush_every ticks, so a crash loses at most that many."""
+        self.file = open(path, 'wb')
+        self.file.write(header.pack(magic, version, seed, *size, fps))
+        self.compressor = zlib.compressobj(9)
+        self.flush_every = flush_every
+
+        self.ticks = 0
+        self.keys = 0
+        self.mouse = (0, 0)
+
+        atexit.register(self.close)
+
+    def write_tick(self, keys, mouse, events):
+        """keys is a bitmask of held keys, mouse a position, and events a
+        list of (type, args) tuples."""
+        flags = 0
+        parts = []
+        if keys != self.keys:
+            flags |= KEYS_CHANGED
+            parts.append(keys_record.pack(keys))
+        if mouse != self.mouse:
+            flags |= MOUSE_MOVED
+            parts.append(mouse_record.pack(mouse[0] - self.mouse[0], mouse[1] - self.mouse[1]))
+        if events:
+            flags |= HAS_EVENTS
+            parts.append(count_record.pack(len(events)))
+            for type, args in events:
+                parts.append(bytes([type]) + event_records[type].pack(*args))
+
+        self.keys = keys
+        self.mouse = mouse
+
+        self.file.write(self.compressor.compress(bytes([flags]) + b''.join(parts)))
+        self.ticks += 1
+        if self.ticks % self.flush_every == 0:
+            self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write(self.compressor.flush())
+            self.file.close()
+
+
+class Reader():
+    def __init__(self, path):
+        """Reads a recording made by Writer. A recording that was cut off,
+        e.g. by a crash, plays up to the last tick that was flushed."""
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        file_magic, file_version, self.seed, width, height, self.fps = header.unpack_from(data)
+        if file_magic != magic:
+            raise ValueError('not a recording')
+        if file_version != version:
+            raise ValueError(f'recording is version {file_version}, expected {version}')
+        self.size = (width, height)
+
+        self.data = zlib.decompressobj().decompress(data[header.size:])
+
+    def ticks(self):
+        """Yield (keys, mouse, events) for every tick, in the same form
+        they were given to Writer.write_tick()."""
+        data = self.data
+        offset = 0
+        keys = 0
+        mouse = (0, 0)
+        while offset < len(data):
+            try:
+                flags = data[offset]
+                offset += 1
+                if flags & KEYS_CHANGED:
+                    keys, = keys_record.unpack_from(data, offset)
+                    offset += keys_record.size
+                if flags & MOUSE_MOVED:
+                    dx, dy = mouse_record.unpack_from(data, offset)
+                    offset += mouse_record.size
+                    mouse = (mouse[0] + dx, mouse[1] + dy)
+                events = []
+                if flags & HAS_EVENTS:
+                    count, = count_record.unpack_from(data, offset)
+                    offset += count_record.size
+                    for i in range(count):
+                        type = data[offset]
+                        record = event_records[type]
+                        events.append((type, record.unpack_from(data, offset + 1)))
+                        offset += 1 + record.size
+            except (IndexError, struct.error):
+                # The last tick was only partly written
+                return
+
+            yield keys, mouse, events
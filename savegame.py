@@ -0,0 +1,194 @@
+import atexit
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from asset_loader import get_path
+
+
+# File layout, all little endian:
+#   header      magic, version, current level, number of levels
+#   player      score, hp, max hp, has crystal, weapon, x, y
+#   each level  level, width, height, number of walls, statics, pickups
+#               and enemies, then a bit per room that is still fogged
+#     walls     type, tile x, tile y
+#     statics   kind, center x, center y
+#     pickups   type, x, y
+#     enemies   kind, center x, center y, hp, velocity x, velocity y
+#   a CRC32 of everything before it
+magic = b'NRSV'
+version = 1
+
+header = struct.Struct('<4sHHH')
+player_record = struct.Struct('<iBBBBii')
+level_record = struct.Struct('<HHHHHHHI')
+wall_record = struct.Struct('<BBB')
+static_record = struct.Struct('<Bhh')
+pickup_record = struct.Struct('<Bhh')
+enemy_record = struct.Struct('<Bhhbff')
+checksum = struct.Struct('<I')
+
+# Names are stored as their index in these lists, so only ever add to the end
+wall_types = ['corner', 'rl', 'ud']
+static_kinds = ['fountain', 'ladder_up', 'ladder_down']
+pickup_types = ['hp', 'cube']
+enemy_kinds = ['crystal', 'archer', 'charger', 'dummy']
+weapons = ['slingshot', 'lasergun']
+
+tile_size = 75
+
+default_path = get_path(os.path.join('saves', 'run.nrsv'))
+
+
+def encode(run):
+    """Pack a run into bytes. A run is a dict with the current 'level', the
+    'player' and every visited level in 'levels', as made by World.snapshot()
+    and Player.snapshot()."""
+    player = run['player']
+    parts = [header.pack(magic, version, run['level'], len(run['levels'])),
+             player_record.pack(player['score'], player['hp'], player['max_hp'],
+                                player['has_crystal'], weapons.index(player['weapon']),
+                                *player['pos'])]
+
+    for level, data in sorted(run['levels'].items()):
+        fog_mask = 0
+        for i, fogged in enumerate(data['fog']):
+            fog_mask |= fogged << i
+
+        parts.append(level_record.pack(level, *data['size'], len(data['walls']), len(data['statics']),
+                                       len(data['pickups']), len(data['enemies']), fog_mask))
+        for type, x, y in data['walls']:
+            parts.append(wall_record.pack(wall_types.index(type), x // tile_size, y // tile_size))
+        for kind, x, y in data['statics']:
+            parts.append(static_record.pack(static_kinds.index(kind), x, y))
+        for type, x, y in data['pickups']:
+            parts.append(pickup_record.pack(pickup_types.index(type), x, y))
+        for kind, x, y, hp, vx, vy in data['enemies']:
+            parts.append(enemy_record.pack(enemy_kinds.index(kind), x, y, hp, vx, vy))
+
+    data = b''.join(parts)
+    return data + checksum.pack(zlib.crc32(data))
+
+
+def decode(data):
+    """Unpack bytes made by encode() back into a run. Raises ValueError if
+    the data is damaged or from a different version of the game."""
+    if len(data) < header.size + checksum.size:
+        raise ValueError('save file is too short')
+    body = memoryview(data)[:-checksum.size]
+    if checksum.unpack_from(data, len(body))[0] != zlib.crc32(body):
+        raise ValueError('save file is damaged')
+
+    file_magic, file_version, cur_level, num_levels = header.unpack_from(body)
+    if file_magic != magic:
+        raise ValueError('not a save file')
+    if file_version != version:
+        raise ValueError(f'save file is version {file_version}, expected {version}')
+
+    # The checksum only proves the bytes are the ones that were written, so
+    # counts or names that don't fit still have to be caught
+    try:
+        return parse(body, cur_level, num_levels)
+    except (struct.error, IndexError) as e:
+        raise ValueError(f'save file is malformed: {e}') from e
+
+
+def parse(body, cur_level, num_levels):
+    """Unpack the records after the header, see decode()."""
+    offset = header.size
+
+    score, hp, max_hp, has_crystal, weapon, x, y = player_record.unpack_from(body, offset)
+    offset += player_record.size
+    player = {'score': score, 'hp': hp, 'max_hp': max_hp, 'has_crystal': bool(has_crystal),
+              'weapon': weapons[weapon], 'pos': (x, y)}
+
+    def records(record, count):
+        nonlocal offset
+        values = list(record.iter_unpack(body[offset:offset + record.size * count]))
+        offset += record.size * count
+        return values
+
+    levels = {}
+    for i in range(num_levels):
+        level, width, height, num_walls, num_statics, num_pickups, num_enemies, fog_mask = \
+            level_record.unpack_from(body, offset)
+        offset += level_record.size
+
+        levels[level] = {'size': (width, height),
+                         'walls': [(wall_types[t], tx * tile_size, ty * tile_size)
+                                   for t, tx, ty in records(wall_record, num_walls)],
+                         'statics': [(static_kinds[k], x, y) for k, x, y in records(static_record, num_statics)],
+                         'pickups': [(pickup_types[t], x, y) for t, x, y in records(pickup_record, num_pickups)],
+                         'enemies': [(enemy_kinds[k], x, y, hp, vx, vy)
+                                     for k, x, y, hp, vx, vy in records(enemy_record, num_enemies)],
+                         'fog': [bool(fog_mask >> room & 1) for room in range(32)]}
+
+    if offset != len(body):
+        raise ValueError('save file has trailing data')
+
+    return {'level': cur_level, 'player': player, 'levels': levels}
+
+
+def write(path, run):
+    """Write a run to path. The file is written next to it and moved into
+    place once it is safely on disk, so a crash never leaves half a save."""
+    data = encode(run)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+
+class AutoSaver():
+    def __init__(self, path=default_path):
+        """Writes runs to disk on a background thread, so encoding and
+        waiting for the disk never hold up a frame. If saves are queued
+        faster than they can be written, only the newest one is kept."""
+        self.path = path
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+        self.thread.start()
+        # Let the last save finish before the game exits
+        atexit.register(self.close)
+
+    def save(self, run):
+        """Queue a run to be saved. The run must not be changed afterwards,
+        so pass a fresh snapshot."""
+        while True:
+            try:
+                self.queue.put_nowait(run)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def run(self):
+        while True:
+            run = self.queue.get()
+            if run is None:
+                return
+            try:
+                write(self.path, run)
+            except OSError as e:
+                # Keep playing if the disk is full or read only
+                self.error = e
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
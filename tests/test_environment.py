@@ -0,0 +1,24 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment
+
+
+def test_same_seed_games_match_when_stepped_alternately():
+    # Both games share the process, and so the camera and mouse, so this
+    # catches anything one game leaves behind that changes the other
+    a = environment.NRogueEnv(5)
+    b = environment.NRogueEnv(5)
+    assert a.reset() == b.reset()
+
+    actions = random.Random(0)
+    for i in range(300):
+        action = [actions.choice([-1, 0, 1]), actions.choice([-1, 0, 1]),
+                  actions.random() < .3, actions.uniform(-3, 3), 0]
+        obs_a, reward_a, done_a, info_a = a.step(action)
+        obs_b, reward_b, done_b, info_b = b.step(action)
+        assert obs_a == obs_b, f'games split at step {i}'
+        assert (reward_a, done_a, info_a) == (reward_b, done_b, info_b)